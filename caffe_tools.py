@@ -2,10 +2,21 @@
 # interface
 
 import caffe
+import time
+import threading
+import resource
+import multiprocessing
+import glog as log
+from multiprocessing.pool import ThreadPool
+from PIL import Image
 from skimage.io import imread
 import numpy as np
 from scipy.misc import imresize
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+
+# The float data in caffe datum is 32-bit, so any non-uint8 array is
+# stored as float32 by default
+DATUM_FLOAT_DTYPE = np.float32
 
 
 # The following two class is extracted from the caffe example script
@@ -56,6 +67,70 @@ class SimpleTransformer:
 
         return np.uint8(im)
 
+    def _mean_chw(self):
+        """
+        The mean in [channel, 1, 1] or [channel, height, width] shape,
+        which can be broadcast to the CHW blob
+        """
+        mean = np.asarray(self.mean, dtype=np.float32)
+        if mean.ndim == 3:
+            return mean.transpose((2, 0, 1))
+        return mean.reshape(-1, 1, 1)
+
+    def preprocess_batch(self, images, out=None):
+        """
+        The batch version of preprocess(), the images is a [n, h, w, c]
+        RGB array or a list of [h, w, c] RGB images with the same shape.
+        The result is written into the [n, c, h, w] float32 buffer out
+        (allocated if None) and returned.
+        The channel swap and the transpose are views, the mean subtraction
+        writes directly into out, so there is no temporary copy.
+        NOTE:
+            Pass a [n, h, w, c] array to avoid the per-image loop
+        """
+        if isinstance(images, np.ndarray):
+            shape = images.shape
+        else:
+            shape = (len(images),) + np.shape(images[0])
+        if out is None:
+            out = np.empty([shape[0], shape[3], shape[1], shape[2]],
+                           dtype=np.float32)
+        mean = self._mean_chw()
+
+        if isinstance(images, np.ndarray):
+            # RGB to BGR, and NHWC to NCHW
+            np.subtract(images[:, :, :, ::-1].transpose((0, 3, 1, 2)),
+                        mean, out=out, casting='unsafe')
+        else:
+            for idx, im in enumerate(images):
+                np.subtract(np.asarray(im)[:, :, ::-1].transpose((2, 0, 1)),
+                            mean, out=out[idx], casting='unsafe')
+        if self.scale != 1.0:
+            out *= self.scale
+
+        return out
+
+    def deprocess_batch(self, blobs, out=None):
+        """
+        inverse of preprocess_batch(), the blobs is [n, c, h, w], and the
+        result is the [n, h, w, c] RGB uint8 images, written into out
+        (allocated if None). The blobs will not be changed.
+        """
+        if out is None:
+            out = np.empty([blobs.shape[0], blobs.shape[2], blobs.shape[3],
+                            blobs.shape[1]], dtype=np.uint8)
+        im = np.divide(blobs, self.scale, dtype=np.float32)
+        im += self._mean_chw()
+        # BGR to RGB, and NCHW to NHWC
+        np.copyto(out, im[:, ::-1, :, :].transpose((0, 2, 3, 1)),
+                  casting='unsafe')
+
+        return out
+
+
+# The transform object shared by the load_image*_ready_for_blob
+_default_transformer = SimpleTransformer()
+
 
 class CaffeSolver:
 
@@ -178,31 +253,198 @@ def load_image_to_datum(image_name, resize_height=None,
     return im_dat
 
 
+class ImageBatchLoader:
+    """
+    Load a list of images into a preallocated [n, 3, h, w] BGR batch
+    buffer, which is the directory-scale version of load_image_to_datum.
+    1. The image is decoded by PIL, and for JPEG the draft() mode is used
+    so that the decoder directly produces a reduced size image when the
+    image will be downscaled.
+    2. The resize, RGB to BGR, HWC to CHW and the dtype conversion is
+    written into the batch buffer in one copy.
+    3. The images are decoded in a thread pool (PIL release the GIL when
+    decoding), the pool and the resample setting are reused across calls.
+
+    load(image_list, out=None):
+        Return the [n, 3, h, w] batch, if out is given, it is filled
+        in place.
+
+    load_datum(image_list):
+        Return the datum list of the images
+
+    get_counter():
+        Return [image_num, image/s, MB/s] since the loader is created
+
+    close():
+        Close the thread pool
+    """
+    def __init__(self, resize_height, resize_width, normalize=False,
+                 thread_num=8, resample=Image.BILINEAR, echo_interval=1000):
+        """
+        If normalize is False, the batch is uint8 0-255 value, else it
+        is float32 0-1 value.
+        The echo_interval is the image number between two progress logs,
+        set to None to disable the progress log
+        """
+        self.height = resize_height
+        self.width = resize_width
+        self.normalize = normalize
+        self._resample = resample
+        if normalize:
+            self.dtype = np.dtype(np.float32)
+        else:
+            self.dtype = np.dtype(np.uint8)
+        self._pool = ThreadPool(thread_num)
+        self._echo_interval = echo_interval
+        # The progress and throughput counters
+        self.mutex = threading.Lock()
+        self._counter = 0
+        self._bytes = 0
+        self._start_time = time.time()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def alloc(self, num):
+        """
+        Allocate the batch buffer for num images
+        """
+        return np.empty([num, 3, self.height, self.width], dtype=self.dtype)
+
+    def load(self, image_list, out=None):
+        """
+        Load the images into the batch buffer [n, 3, h, w] with BGR order
+        """
+        if out is None:
+            out = self.alloc(len(image_list))
+        elif out.shape[0] < len(image_list) or \
+                out.shape[1:] != (3, self.height, self.width):
+            log.error('\033[01;31mERROR\033[0m: The shape of the batch \
+buffer %s does not fit %d images of [3, %d, %d]'
+                      % (str(out.shape), len(image_list),
+                         self.height, self.width))
+            return None
+
+        self._pool.map(lambda idx: self._load_one(image_list[idx],
+                                                  out[idx]),
+                       range(len(image_list)))
+        return out
+
+    def load_datum(self, image_list):
+        """
+        Load the images, and convert them into datum list
+        """
+        batch = self.load(image_list)
+        if batch is None:
+            return None
+        return [array_to_datum(batch[idx]) for idx in range(len(batch))]
+
+    def get_counter(self):
+        """
+        Return [image_num, image/s, MB/s], the MB is the size of the
+        decoded image in the batch buffer
+        """
+        elapse = max(time.time() - self._start_time, 1e-6)
+        return [self._counter, self._counter / elapse,
+                self._bytes / elapse / 1024.0 / 1024.0]
+
+    def _load_one(self, image_name, out):
+        """
+        Decode one image and write it into out [3, h, w]
+        """
+        img = Image.open(image_name)
+        # Let the JPEG decoder produce the smallest scale larger than
+        # the target size, it is a no-op for other format
+        img.draft('RGB', (self.width, self.height))
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        if img.size != (self.width, self.height):
+            img = img.resize((self.width, self.height), self._resample)
+        arr = np.asarray(img)
+        # RGB to BGR and HWC to CHW are views, the only copy is here
+        arr = arr[:, :, ::-1].transpose((2, 0, 1))
+        if self.normalize:
+            np.multiply(arr, np.float32(1.0 / 255.0), out=out)
+        else:
+            np.copyto(out, arr, casting='unsafe')
+        self._count(out.nbytes)
+
+    def _count(self, nbytes):
+        self.mutex.acquire()
+        self._counter += 1
+        self._bytes += nbytes
+        counter = self._counter
+        self.mutex.release()
+        if self._echo_interval is not None and \
+                counter % self._echo_interval == 0:
+            num, ips, mbps = self.get_counter()
+            log.info('Loaded \033[01;31m%d\033[0m images, %.1f images/s, \
+%.1f MB/s' % (num, ips, mbps))
+
+
+def _get_datum_dtype(arr, dtype=None):
+    """
+    The dtype policy of the array which will be stored into the datum.
+    1. If the dtype is set, use it.
+    2. The uint8 array is kept as uint8, which will be stored in the
+    datum.data as bytes.
+    3. All other arrays are stored in datum.float_data, which is 32-bit
+    in caffe, so float32 is used, and the float32 array will not be
+    converted at all.
+    """
+    if dtype is not None:
+        return np.dtype(dtype)
+    if arr.dtype == np.uint8:
+        return np.dtype(np.uint8)
+    return np.dtype(DATUM_FLOAT_DTYPE)
+
+
+def array_to_datum(arr):
+    """
+    Same as caffe.io.array_to_datum, but the float array is NOT upcast
+    to float64 before it is filled into the float_data.
+    The arr must be [channel, height, width]
+    """
+    datum = caffe.proto.caffe_pb2.Datum()
+    datum.channels, datum.height, datum.width = arr.shape
+    if arr.dtype == np.uint8:
+        datum.data = arr.tobytes()
+    else:
+        datum.float_data.extend(arr.flat)
+    return datum
+
+
 def load_array_to_datum(arr, dtype=None):
     """This function store the float array into the datum, and return
     the datum.
     This approach is commonly used in the regression model, when the
     label is a float (vector) instead of a single int value.
+    NOTE:
+        If dtype is None, the uint8 array remains uint8, and others
+        are stored as float32 (see _get_datum_dtype), the float32 array
+        will not be copied before put into the datum.
     """
-    arr = np.array(arr)
-    if dtype is None:
-        if arr.dtype == np.uint8:
-            dtype = np.uint8
-        else:
-            dtype = np.float64
+    arr = np.asarray(arr)
+    dtype = _get_datum_dtype(arr, dtype)
 
     # The arr must have 3 dimension
     if arr.ndim == 0:
-        arr = arr.astype(dtype).reshape(1, 1, 1)
+        arr = arr.reshape(1, 1, 1)
     elif arr.ndim == 1:
-        arr = arr.astype(dtype).reshape(arr.shape[0], 1, 1)
+        arr = arr.reshape(arr.shape[0], 1, 1)
     elif arr.ndim == 2:
-        arr = arr.astype(dtype).reshape(arr.shape[0], arr.shape[1], 1)
-    elif arr.ndim == 3:
-        arr = arr.astype(dtype)
-    else:
+        arr = arr.reshape(arr.shape[0], arr.shape[1], 1)
+    elif arr.ndim != 3:
         return None
-    im_dat = caffe.io.array_to_datum(arr)
+    # Only convert once, and only if needed
+    arr = arr.astype(dtype, copy=False)
+    im_dat = array_to_datum(arr)
 
     return im_dat
 
@@ -227,30 +469,29 @@ def load_array_im_to_datum(arr, dtype=None, force_swith_channel=False):
         to BGR.
         And if the force_swith_channel set to True, it will change the change
         the channels by force
+        The dtype policy is the same as load_array_to_datum, the channel
+        swap and the transpose are views, so the only copy is the dtype
+        conversion (if needed).
     """
-    arr = np.array(arr)
-    if dtype is None:
-        if arr.dtype == np.uint8:
-            dtype = np.uint8
-        else:
-            dtype = np.float64
+    arr = np.asarray(arr)
+    dtype = _get_datum_dtype(arr, dtype)
 
     # The arr must have 3 dimension
     if arr.ndim == 0:
-        arr = arr.astype(dtype).reshape(1, 1, 1)
+        arr = arr.reshape(1, 1, 1)
     elif arr.ndim == 1:
-        arr = arr.astype(dtype).reshape(arr.shape[0], 1, 1)
+        arr = arr.reshape(arr.shape[0], 1, 1)
     elif arr.ndim == 2:
-        arr = arr.astype(dtype).reshape(arr.shape[0], arr.shape[1], 1)
+        arr = arr.reshape(arr.shape[0], arr.shape[1], 1)
     elif arr.ndim == 3:
-        arr = arr.astype(dtype)
         if arr.shape[2] == 3 and \
                 (dtype == np.uint8 or force_swith_channel is True):
             # Change RGB to BGR
-            arr = arr[:, :, (2, 1, 0)]
+            arr = arr[:, :, ::-1]
     else:
         return None
-    im_dat = caffe.io.array_to_datum(arr.astype(dtype).transpose((2, 0, 1)))
+    arr = arr.astype(dtype, copy=False)
+    im_dat = array_to_datum(arr.transpose((2, 0, 1)))
 
     return im_dat
 
@@ -260,17 +501,91 @@ def load_array_im_to_datum_str(arr, dtype=None):
     return im_dat.SerializeToString()
 
 
+def _legacy_array_im_to_datum(arr):
+    """
+    The legacy float path of load_array_im_to_datum: np.array copy,
+    astype(float64) twice, and caffe.io.array_to_datum upcast it again
+    """
+    tmp = np.array(arr).astype(np.float64)
+    return caffe.io.array_to_datum(tmp.astype(np.float64).transpose((2, 0, 1)))
+
+
+def _peak_mem_worker(func, arr, repeat, queue):
+    """
+    Run func(arr) in the child process, and put the growth of the peak
+    RSS (bytes) and the time (sec per call) into the queue
+    """
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    for i in range(repeat):
+        func(arr)
+    elapse = (time.time() - start) / repeat
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The ru_maxrss is in KB on linux
+    queue.put([(peak - base) * 1024, elapse])
+
+
+def _measure_peak_mem(func, arr, repeat):
+    """
+    Measure the peak memory and the time of func(arr) in a fresh child
+    process, so the peak of one path is not hidden by the other
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_peak_mem_worker,
+                                   args=(func, arr, repeat, queue))
+    proc.start()
+    mem, elapse = queue.get()
+    proc.join()
+    return mem, elapse
+
+
+def benchmark_array_to_datum(height=480, width=640, channels=1,
+                             repeat=20, dtype_list=('float32', 'float64')):
+    """
+    Compare the legacy float64 path (caffe.io.array_to_datum) with the
+    dtype-preserving path of load_array_im_to_datum on random maps of
+    each dtype, e.g. a float32 depth map.
+    Each path runs in its own child process, and the transient memory is
+    the growth of the peak RSS while converting.
+    Return a dict of dtype -> dict contains the time (sec per image) and
+    the peak memory growth (bytes) of both path.
+    """
+    rst = {}
+    for dtype in dtype_list:
+        arr = np.random.rand(height, width, channels).astype(dtype)
+        legacy_mem, legacy_time = _measure_peak_mem(
+            _legacy_array_im_to_datum, arr, repeat)
+        new_mem, new_time = _measure_peak_mem(
+            load_array_im_to_datum, arr, repeat)
+        rst[dtype] = {'legacy_time': legacy_time,
+                      'new_time': new_time,
+                      'legacy_mem': legacy_mem,
+                      'new_mem': new_mem}
+        log.info('array_to_datum [%d, %d, %d] %s: legacy %.2f ms, %d KB; \
+new path %.2f ms, %d KB' % (height, width, channels, dtype,
+                            legacy_time * 1000, legacy_mem / 1024,
+                            new_time * 1000, new_mem / 1024))
+    return rst
+
+
 def load_image_ready_for_blob(image_name):
     """Load an image according to the name, and prepare the image
     for the caffe model's input blob.
     It will transfer the image shape to fit the input blob
     """
-    # The transform object to preprocess the image
-    transformer = SimpleTransformer()
     # Load the image
     im = load_image(image_name)
     # Transform the image (RGB to BGR, transpose the channel)
-    return transformer.preprocess(im)
+    return _default_transformer.preprocess(im)
+
+
+def load_images_ready_for_blob(image_list, out=None):
+    """Batch version of load_image_ready_for_blob, the images must have
+    the same size, and the result is the [n, c, h, w] blob data.
+    If out is set, the blob is written into it.
+    """
+    im_list = [load_image(image_name) for image_name in image_list]
+    return _default_transformer.preprocess_batch(im_list, out)
 
 
 def parse_string_to_datum(datum_str):
@@ -329,6 +644,19 @@ def datum_str_to_array(datum_str):
     return arr
 
 
+def datum_to_array_fast(datum):
+    """
+    Same as caffe.io.datum_to_array, but the uint8 data is read by
+    np.frombuffer without copy, and the float data is kept as float32
+    instead of float64.
+    The return array is [channel, height, width]
+    """
+    shape = (datum.channels, datum.height, datum.width)
+    if len(datum.data):
+        return np.frombuffer(datum.data, dtype=np.uint8).reshape(shape)
+    return np.array(datum.float_data, dtype=np.float32).reshape(shape)
+
+
 def _pca_feature_map(blob_data, pca_dim=3):
     """
     This function use PCA to turn the [1, c, h, w] feature map blob
@@ -343,6 +671,8 @@ def _pca_feature_map(blob_data, pca_dim=3):
     """
     if len(blob_data.shape) == 4:
         data = blob_data[0, :, :, :]
+    else:
+        data = blob_data
     data = data.transpose([1, 2, 0])
     # Generate the PCA model
     pca = PCA(n_components=pca_dim)
@@ -350,12 +680,85 @@ def _pca_feature_map(blob_data, pca_dim=3):
     pca.fit(data.reshape(-1, data.shape[-1]))
     # Reduce the dim
     data = pca.transform(data.reshape(-1, org_shape[-1]))
-    data = data.reshape(org_shape[0], org_shape[1], 3)
+    data = data.reshape(org_shape[0], org_shape[1], pca_dim)
 
     return data
 
 
-def pca_feature_map(blob_data, pca_dim=3):
+class FeaturePCA:
+    """
+    The PCA projection shared by all items of the feature map blob.
+    Different from _pca_feature_map which fit a PCA for each item, this
+    class fit ONE projection on a subsample of pixels from the whole
+    batch (randomized SVD, or incremental PCA which can be updated by
+    more batches), and project all items by a single matrix multiply.
+    So the colors are comparable across images, and the fitted object
+    can be reused across calls.
+
+    fit(blob_data):
+        Fit (or update, if incremental) the projection
+    transform(blob_data):
+        Project the [n, c, h, w] blob to [n, h, w, pca_dim], and the
+        [1, c, h, w] or [c, h, w] blob to [h, w, pca_dim]
+    """
+    def __init__(self, pca_dim=3, sample_num=100000, incremental=False):
+        self.pca_dim = pca_dim
+        self.sample_num = sample_num
+        if incremental:
+            self._pca = IncrementalPCA(n_components=pca_dim)
+        else:
+            self._pca = PCA(n_components=pca_dim, svd_solver='randomized')
+        self._incremental = incremental
+        self.components = None
+        self._offset = None
+
+    def fit(self, blob_data):
+        data = self._sample_pixels(blob_data)
+        if self._incremental:
+            self._pca.partial_fit(data)
+        else:
+            self._pca.fit(data)
+        # transform(x) = (x - mean) * C^T = x * C^T - mean * C^T
+        self.components = self._pca.components_.T.astype(np.float32)
+        self._offset = np.dot(self._pca.mean_, self.components)
+        return self
+
+    def transform(self, blob_data):
+        if self.components is None:
+            log.error('\033[01;31mERROR\033[0m: The FeaturePCA is not fitted')
+            return None
+        squeeze = blob_data.ndim == 3 or blob_data.shape[0] == 1
+        if blob_data.ndim == 3:
+            blob_data = blob_data[np.newaxis, :, :, :]
+        n, c, h, w = blob_data.shape
+        data = blob_data.transpose((0, 2, 3, 1)).reshape(-1, c)
+        rst = np.dot(data, self.components)
+        rst -= self._offset
+        rst = rst.reshape(n, h, w, self.pca_dim)
+        if squeeze:
+            return rst[0]
+        return rst
+
+    def fit_transform(self, blob_data):
+        return self.fit(blob_data).transform(blob_data)
+
+    def _sample_pixels(self, blob_data):
+        """
+        Randomly pick at most sample_num pixels of all items, and return
+        the [sample_num, c] data
+        """
+        if blob_data.ndim == 3:
+            blob_data = blob_data[np.newaxis, :, :, :]
+        n, c = blob_data.shape[0: 2]
+        data = blob_data.reshape(n, c, -1)
+        pixel_num = n * data.shape[2]
+        if pixel_num <= self.sample_num:
+            return data.transpose((0, 2, 1)).reshape(-1, c)
+        idx = np.random.choice(pixel_num, self.sample_num, replace=False)
+        return data[idx // data.shape[2], :, idx % data.shape[2]]
+
+
+def pca_feature_map(blob_data, pca_dim=3, shared=False, pca=None):
     """
     This is a wrapper of the _pca_feature_map.
     This function can take the blob data with n larger than 1
@@ -363,7 +766,16 @@ def pca_feature_map(blob_data, pca_dim=3):
     The output will be [n, h, w, pca_dim]
     When the input is [1, c, h, w] or [c, h, w]
     The output will be [h, w, pca_dim]
+
+    shared: If True, fit one projection for the whole batch by FeaturePCA
+    pca: The fitted FeaturePCA, if set, it is used to project the blob
+        without fitting, which keep the colors consistent across calls
     """
+    if pca is not None:
+        return pca.transform(blob_data)
+    if shared:
+        return FeaturePCA(pca_dim=pca_dim).fit_transform(blob_data)
+
     if len(blob_data.shape) == 4 and blob_data.shape[0] > 1:
         rst = np.zeros([blob_data.shape[0],
                         blob_data.shape[2],
@@ -52,3 +52,26 @@ def get_image_dict_from_datalist(datalist):
                 txt_tools.string_list_to_float_list(word_list[1:])
 
     return data_dict
+
+
+def get_image_label_list_from_datalist(datalist):
+    """This function read the datalist and return it as a list of
+    [image_path, label] with the same order as the datalist.
+    The label is None, a float or a float list, same as the value of
+    get_image_dict_from_datalist
+    """
+    datalist_list = txt_tools.read_lines_from_txtfile(datalist)
+    data_list = []
+    for line in datalist_list:
+        word_list = line.split()
+        if len(word_list) == 0:
+            continue
+        if len(word_list) == 1:
+            label = None
+        elif len(word_list) == 2:
+            label = float(word_list[1])
+        else:
+            label = txt_tools.string_list_to_float_list(word_list[1:])
+        data_list.append([word_list[0], label])
+
+    return data_list
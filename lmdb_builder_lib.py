@@ -0,0 +1,279 @@
+#!/usr/bin/python
+
+# This module build the image lmdb and the label lmdb from a datalist.
+# The images are decoded and encoded in parallel, and written by a
+# single writer thread. The build progress is stored in the db itself,
+# so an interrupted build can be resumed.
+
+import argparse
+import os
+import Queue
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import glog as log
+import caffe_tools
+import datalist_tools
+import lmdb_tools
+import path_tools
+
+# The key which store the build progress (the number of finished
+# entries), it is committed in the same transaction with the data, and
+# it is deleted when the build is finished, so caffe never sees it.
+PROGRESS_KEY = '__build_progress__'
+
+
+def get_key(idx, image_name):
+    """
+    The key of the idx-th entry, the image db and the label db use the
+    same key, and the zero padded idx keeps the order of the datalist
+    """
+    return '%08d_%s' % (idx, path_tools.get_pure_name(image_name))
+
+
+def get_progress(db):
+    """
+    Return the number of finished entries of an unfinished build.
+    If the db is not built by the builder or the build is finished,
+    return None
+    """
+    with db.begin(write=False) as txn:
+        val = txn.get(PROGRESS_KEY)
+    if val is None:
+        return None
+    return int(val)
+
+
+class LmdbBuilder:
+    """
+    Build the image lmdb and the label lmdb with aligned keys from
+    a datalist, each line of the datalist is:
+        image_path [label ...]
+    If there is no label in the datalist, the label db is not built.
+
+    build(datalist):
+        Build the dbs, if the dbs contains an unfinished build and
+        resume is True, the build continues from where it stopped.
+    """
+    def __init__(self, image_db, label_db=None, resize_height=256,
+                 resize_width=256, batch_size=256, thread_num=8,
+                 resume=True):
+        self.image_db_file = image_db
+        self.label_db_file = label_db
+        self.batch_size = batch_size
+        self.thread_num = thread_num
+        self.resume = resume
+        # The decode workers
+        self._loader = caffe_tools.ImageBatchLoader(resize_height,
+                                                    resize_width,
+                                                    thread_num=thread_num,
+                                                    echo_interval=None)
+        # The encode workers
+        self._pool = ThreadPool(thread_num)
+        # The batches wait to be written by the writer thread
+        self._queue = Queue.Queue(maxsize=4)
+        self._image_db = None
+        self._label_db = None
+        # The exception raised in the writer thread
+        self._writer_error = None
+        # The counters
+        self._counter = 0
+        self._bytes = 0
+
+    def build(self, datalist):
+        """
+        Build the dbs from the datalist, return the entries number
+        of the image db
+        """
+        data_list = datalist_tools.get_image_label_list_from_datalist(
+            datalist)
+        if len(data_list) == 0:
+            log.error('\033[01;31mERROR\033[0m: The datalist %s is empty'
+                      % datalist)
+            return None
+        if data_list[0][1] is None:
+            self.label_db_file = None
+
+        start_idx = self._open_db()
+        if start_idx is None:
+            return None
+        if start_idx > 0:
+            log.info('Resume the build from \033[01;31m%d\033[0m / %d'
+                     % (start_idx, len(data_list)))
+
+        self._writer_error = None
+        writer = threading.Thread(target=self._writer_thread)
+        writer.start()
+        start_time = time.time()
+        entries = None
+        try:
+            for idx in range(start_idx, len(data_list), self.batch_size):
+                batch_list = data_list[idx: idx + self.batch_size]
+                val = self._encode(idx, batch_list)
+                self._check_writer()
+                self._queue.put(val)
+                elapse = max(time.time() - start_time, 1e-6)
+                log.info('%d / %d, %.1f images/s, %.1f MB/s'
+                         % (idx + len(batch_list), len(data_list),
+                            self._counter / elapse,
+                            self._bytes / elapse / 1024.0 / 1024.0))
+            # Signal the writer to flush and exit
+            self._queue.put(None)
+            writer.join()
+            # The failed build keeps the progress, so it can be resumed
+            self._check_writer()
+
+            # Finished, remove the progress
+            if self._label_db is not None:
+                self._finish(self._label_db)
+            self._finish(self._image_db)
+            entries = lmdb_tools.get_entries(self._image_db)
+        finally:
+            if writer.is_alive():
+                # Failed, the written batches keep their progress, so the
+                # build can be resumed
+                self._queue.put(None)
+                writer.join()
+            self._close_db()
+            self._loader.close()
+            self._pool.close()
+            self._pool.join()
+
+        log.info('Finished \033[0;32m%s\033[0m, entries: \033[0;31m%d\033[0m'
+                 % (self.image_db_file, entries))
+        return entries
+
+    def _open_db(self):
+        """
+        Open the dbs and return the idx where the build should start.
+        Return None if the dbs can not be built
+        """
+        exists = os.path.exists(self.image_db_file)
+        self._image_db = lmdb_tools.open(self.image_db_file,
+                                         append=self.resume)
+        if self.label_db_file is not None:
+            self._label_db = lmdb_tools.open(self.label_db_file,
+                                             append=self.resume)
+        if not exists or lmdb_tools.get_entries(self._image_db) == 0:
+            return 0
+
+        # The label db is always written and finished before the image
+        # db, so the progress of the image db is never ahead of it
+        progress = get_progress(self._image_db)
+        if progress is None:
+            log.error('\033[01;31mERROR\033[0m: %s is not empty, and it does \
+not contain an unfinished build' % self.image_db_file)
+            self._close_db()
+            return None
+        return progress
+
+    def _close_db(self):
+        lmdb_tools.close(self._image_db)
+        self._image_db = None
+        if self._label_db is not None:
+            lmdb_tools.close(self._label_db)
+            self._label_db = None
+
+    def _encode(self, start_idx, batch_list):
+        """
+        Decode the images and encode the images and labels into datum
+        strings, return [end_idx, key_list, image_str_list, label_str_list]
+        """
+        image_list = [val[0] for val in batch_list]
+        batch = self._loader.load(image_list)
+        key_list = [get_key(start_idx + idx, image_list[idx])
+                    for idx in range(len(image_list))]
+        image_str_list = self._pool.map(
+            lambda idx: caffe_tools.array_to_datum(
+                batch[idx]).SerializeToString(),
+            range(len(image_list)))
+        if self._label_db is not None:
+            label_str_list = self._pool.map(
+                lambda val: caffe_tools.load_array_to_datum_str(val[1]),
+                batch_list)
+        else:
+            label_str_list = None
+        return [start_idx + len(batch_list), key_list, image_str_list,
+                label_str_list]
+
+    def _write(self, db, end_idx, key_list, val_list):
+        """
+        Write the batch and the progress in one transaction
+        """
+        with db.begin(write=True) as txn:
+            for key, val in zip(key_list, val_list):
+                txn.put(key, val)
+            txn.put(PROGRESS_KEY, str(end_idx))
+
+    def _finish(self, db):
+        with db.begin(write=True) as txn:
+            txn.delete(PROGRESS_KEY)
+
+    def _check_writer(self):
+        """
+        Re-raise the exception of the writer thread in the build
+        """
+        if self._writer_error is not None:
+            raise self._writer_error
+
+    def _writer_thread(self):
+        """
+        The single writer, it keeps writing the batches in the queue
+        until it gets None. If the write failed (e.g. MapFullError), the
+        exception is stored, and the rest batches are dropped so the build
+        is never blocked on the full queue
+        """
+        while True:
+            val = self._queue.get()
+            if val is None:
+                break
+            if self._writer_error is not None:
+                continue
+            end_idx, key_list, image_str_list, label_str_list = val
+            try:
+                # The label db is written first
+                if label_str_list is not None:
+                    self._write(self._label_db, end_idx, key_list,
+                                label_str_list)
+                    self._bytes += sum([len(v) for v in label_str_list])
+                self._write(self._image_db, end_idx, key_list,
+                            image_str_list)
+                self._bytes += sum([len(v) for v in image_str_list])
+                self._counter += len(key_list)
+            except Exception as e:
+                log.error('\033[01;31mERROR\033[0m: Failed to write the \
+batch before %d: %s' % (end_idx, str(e)))
+                self._writer_error = e
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the image and label lmdb from a datalist')
+    parser.add_argument('datalist', help='The datalist, each line is: \
+image_path [label ...]')
+    parser.add_argument('image_db', help='The output image lmdb')
+    parser.add_argument('--label_db', default=None,
+                        help='The output label lmdb')
+    parser.add_argument('--height', type=int, default=256,
+                        help='The resized height of the images')
+    parser.add_argument('--width', type=int, default=256,
+                        help='The resized width of the images')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='The number of images per transaction')
+    parser.add_argument('--thread_num', type=int, default=8,
+                        help='The number of decode and encode workers')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='Do not resume the unfinished build')
+    args = parser.parse_args()
+
+    builder = LmdbBuilder(args.image_db, args.label_db,
+                          resize_height=args.height,
+                          resize_width=args.width,
+                          batch_size=args.batch_size,
+                          thread_num=args.thread_num,
+                          resume=not args.no_resume)
+    builder.build(args.datalist)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+
+# This module calculate the statistics of an image lmdb, such as the
+# mean image used by the --mean_file of classify.py and detect.py.
+# The lmdb is split into key ranges, and each range is read and
+# accumulated by an independent process.
+
+import argparse
+import multiprocessing
+import numpy as np
+import glog as log
+import caffe_tools
+import lmdb_tools
+import timer_lib
+
+
+class ImageStatis:
+    """
+    The mergeable partial sums of the images, all values are accumulated
+    in float64. The images are [channel, height, width].
+
+    update(arr):
+        Add an image
+    merge(statis):
+        Add the partial sums of another ImageStatis
+    """
+    def __init__(self):
+        self.count = 0
+        # The number of the skipped images whose shape is different
+        self.skipped = 0
+        self.shape = None
+        self.sum = None
+        self.ch_sum = None
+        self.ch_sqsum = None
+        self.ch_min = None
+        self.ch_max = None
+
+    def update(self, arr):
+        if self.shape is None:
+            self._init(arr.shape)
+        elif arr.shape != self.shape:
+            self.skipped += 1
+            return
+        arr = arr.astype(np.float64)
+        self.sum += arr
+        flat = arr.reshape(arr.shape[0], -1)
+        self.ch_sum += flat.sum(axis=1)
+        self.ch_sqsum += np.einsum('ij,ij->i', flat, flat)
+        np.minimum(self.ch_min, flat.min(axis=1), out=self.ch_min)
+        np.maximum(self.ch_max, flat.max(axis=1), out=self.ch_max)
+        self.count += 1
+
+    def merge(self, statis):
+        self.skipped += statis.skipped
+        if statis.count == 0:
+            return
+        if self.shape is None:
+            self._init(statis.shape)
+        elif statis.shape != self.shape:
+            log.warn('\033[01;33mWARNING\033[0m: Can not merge the statis \
+with shape %s into %s' % (str(statis.shape), str(self.shape)))
+            self.skipped += statis.count
+            return
+        self.sum += statis.sum
+        self.ch_sum += statis.ch_sum
+        self.ch_sqsum += statis.ch_sqsum
+        np.minimum(self.ch_min, statis.ch_min, out=self.ch_min)
+        np.maximum(self.ch_max, statis.ch_max, out=self.ch_max)
+        self.count += statis.count
+
+    def mean_image(self):
+        """
+        The [channel, height, width] mean image
+        """
+        return self.sum / self.count
+
+    def channel_mean(self):
+        return self.ch_sum / self._pixel_num()
+
+    def channel_std(self):
+        mean = self.channel_mean()
+        var = self.ch_sqsum / self._pixel_num() - mean * mean
+        return np.sqrt(np.maximum(var, 0))
+
+    def _pixel_num(self):
+        return float(self.count * self.shape[1] * self.shape[2])
+
+    def _init(self, shape):
+        self.shape = tuple(shape)
+        self.sum = np.zeros(shape, dtype=np.float64)
+        self.ch_sum = np.zeros(shape[0], dtype=np.float64)
+        self.ch_sqsum = np.zeros(shape[0], dtype=np.float64)
+        self.ch_min = np.full(shape[0], np.inf)
+        self.ch_max = np.full(shape[0], -np.inf)
+
+
+def get_shard_keys(db, shard_num):
+    """
+    Split the keys of the db into shard_num ranges, return the start key
+    of each range. Only the keys are read.
+    """
+    with db.begin(write=False) as txn:
+        with txn.cursor() as cur:
+            key_list = list(cur.iternext(keys=True, values=False))
+    if len(key_list) == 0:
+        return []
+    step = max(1, int(np.ceil(len(key_list) / float(shard_num))))
+    return key_list[::step]
+
+
+def _statis_shard(param):
+    """
+    Accumulate the statis of the keys in [start_key, end_key)
+    If the end_key is None, read to the end of the db
+    """
+    db_file, start_key, end_key = param
+    statis = ImageStatis()
+    db = lmdb_tools.open_ro(db_file)
+    try:
+        with db.begin(write=False, buffers=True) as txn:
+            with txn.cursor() as cur:
+                if not cur.set_range(start_key):
+                    return statis
+                for key, val in cur:
+                    if end_key is not None and bytes(key) >= end_key:
+                        break
+                    datum = caffe_tools.parse_string_to_datum(bytes(val))
+                    # The encoded (e.g. JPEG) datum is not decoded
+                    if datum is None or datum.encoded:
+                        statis.skipped += 1
+                        continue
+                    try:
+                        arr = caffe_tools.datum_to_array_fast(datum)
+                    except ValueError:
+                        # The data size does not match the shape
+                        statis.skipped += 1
+                        continue
+                    statis.update(arr)
+    finally:
+        lmdb_tools.close(db)
+    return statis
+
+
+def calc_db_statis(db_file, process_num=None):
+    """
+    Calc the statis of the image lmdb with process_num processes, if the
+    process_num is None, use the cpu number. Return the ImageStatis
+    """
+    if process_num is None:
+        process_num = multiprocessing.cpu_count()
+    db = lmdb_tools.open_ro(db_file)
+    if db is None:
+        log.error('\033[01;31mERROR\033[0m: Can not open the db file %s'
+                  % db_file)
+        return None
+    # Use more shards than process to balance the load
+    start_list = get_shard_keys(db, process_num * 4)
+    lmdb_tools.close(db)
+    end_list = start_list[1:] + [None]
+    param_list = [[db_file, start, end]
+                  for start, end in zip(start_list, end_list)]
+
+    timer = timer_lib.timer(start=True)
+    statis = ImageStatis()
+    pool = multiprocessing.Pool(process_num)
+    for shard in pool.imap_unordered(_statis_shard, param_list):
+        statis.merge(shard)
+    pool.close()
+    pool.join()
+    timer.stop()
+
+    log.info('Calc the statis of \033[0;32m%d\033[0m images in %s'
+             % (statis.count, timer.to_str()))
+    if statis.skipped > 0:
+        log.warn('\033[01;33mWARNING\033[0m: Skipped \033[0;31m%d\033[0m \
+entries which can not be parsed, are encoded or have different shape'
+                 % statis.skipped)
+    return statis
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Calc the mean image and the channel statis of an \
+image lmdb')
+    parser.add_argument('db_file', help='The image lmdb')
+    parser.add_argument('mean_file', help='The output [C, H, W] mean .npy')
+    parser.add_argument('--process_num', type=int, default=None,
+                        help='The number of reader processes')
+    args = parser.parse_args()
+
+    statis = calc_db_statis(args.db_file, args.process_num)
+    if statis is None or statis.count == 0:
+        return
+    np.save(args.mean_file, statis.mean_image())
+    log.info('Save the mean image to \033[0;32m%s\033[0m' % args.mean_file)
+    log.info('Channel mean: %s' % str(statis.channel_mean()))
+    log.info('Channel std: %s' % str(statis.channel_std()))
+    log.info('Channel min: %s' % str(statis.ch_min))
+    log.info('Channel max: %s' % str(statis.ch_max))
+
+
+if __name__ == '__main__':
+    main()
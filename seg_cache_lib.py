@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# This lib provide the persistent cache of the segmentation results of
+# seg_lib, which is stored in a lmdb. The key is the hash of the image
+# bytes, the method name and the parameters, so the same image segmented
+# with the same setting is only segmented once.
+
+import hashlib
+import struct
+import threading
+import numpy as np
+import glog as log
+import lmdb_tools
+import serialize_lib
+
+
+class seg_cache:
+    """
+    The cache of the label maps, usage:
+        cache = seg_cache('seg_cache.lmdb')
+        seg = seg_lib.seg(cache=cache)
+    or directly:
+        label = cache.get('slic', data)
+        if label is None:
+            label = ...
+            cache.put('slic', data, label)
+    The data is the same as seg_lib.seg.put, [image, param, ...]
+    The label map is stored as uint16 (int32 if the label is out of range)
+    and compressed by serialize_lib, the value is
+        dtype_len:uint8, dtype (e.g. '<i8'), serialized label map
+    so the label map is loaded in the dtype of the segmentation result.
+    NOTE:
+        The cache is thread safe, each get/flush use its own transaction
+    """
+    def __init__(self, db_file, compressor='snappy', buf_size=100):
+        self.db_file = db_file
+        self.db = lmdb_tools.open(db_file, append=True)
+        self._serializer = serialize_lib.serialize_numpy(
+            compressor=compressor)
+        self._mutex = threading.Lock()
+        # The buffer of the [key, val] to be written
+        self._buf = []
+        self._buf_size = buf_size
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, method, data):
+        """
+        The key is method:sha1, the sha1 is calculated on the image bytes
+        and the params, the np.ndarray param (e.g. the pre-segmented label
+        of n-cut) is hashed with its bytes
+        """
+        sha = hashlib.sha1()
+        _update_hash(sha, data)
+        return '%s:%s' % (method, sha.hexdigest())
+
+    def get(self, method, data, key=None):
+        """
+        Return the cached label map, or None if not cached
+        The hit and miss are counted
+        """
+        if key is None:
+            key = self.get_key(method, data)
+        with self._mutex:
+            val = None
+            for buf_key, buf_val in self._buf:
+                if buf_key == key:
+                    val = buf_val
+            if val is None:
+                with self.db.begin() as txn:
+                    val = txn.get(key.encode())
+            if val is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        dtype_len = struct.unpack_from('<B', val, 0)[0]
+        dtype = np.dtype(val[1: 1 + dtype_len].decode())
+        label = self._serializer.loads(val[1 + dtype_len:])
+        return label.astype(dtype)
+
+    def put(self, method, data, label, key=None):
+        """
+        Store the label map, it is written to the db every buf_size puts
+        """
+        if key is None:
+            key = self.get_key(method, data)
+        label = np.asarray(label)
+        dtype = label.dtype.str.encode()
+        if label.min() >= 0 and label.max() <= np.iinfo(np.uint16).max:
+            label = label.astype(np.uint16)
+        else:
+            label = label.astype(np.int32)
+        val = struct.pack('<B', len(dtype)) + dtype + \
+            self._serializer.dumps(label)
+        with self._mutex:
+            self._buf.append([key, val])
+            if len(self._buf) >= self._buf_size:
+                self._flush()
+
+    def flush(self):
+        with self._mutex:
+            self._flush()
+
+    def _flush(self):
+        if len(self._buf) == 0:
+            return
+        with self.db.begin(write=True) as txn:
+            for key, val in self._buf:
+                txn.put(key.encode(), val)
+        self._buf = []
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+    def report(self):
+        """
+        Log the hit ratio
+        """
+        log.info('Seg cache \033[0;32m%s\033[0m hits: %d, misses: %d, \
+hit ratio: \033[01;31m%.2f%%\033[0m' % (self.db_file, self.hits,
+                                        self.misses, self.hit_ratio() * 100))
+
+    def close(self):
+        self.flush()
+        lmdb_tools.close(self.db)
+        self.db = None
+
+
+def _update_hash(sha, data):
+    """
+    Update the hash with the data, which can be the nested list of the
+    np.ndarray and the other params
+    """
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data)
+        sha.update(('array%s%s' % (data.dtype.str, str(data.shape)))
+                   .encode())
+        sha.update(data.data)
+    elif isinstance(data, (list, tuple)):
+        sha.update(('list%d' % len(data)).encode())
+        for item in data:
+            _update_hash(sha, item)
+    else:
+        sha.update(repr(data).encode())
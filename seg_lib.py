@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 # This lib provide a class which can segment the image using ncut method
-# in multi thread method
+# in multi thread or multi process method
 
 import numpy as np
-import time
 import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import scipy.sparse
+import scipy.sparse.csgraph
 import glog as log
 import Queue
 from skimage import segmentation, filters, color
@@ -13,6 +17,12 @@ from skimage.future import graph
 import pymeanshift as pms
 
 
+# The default worker number of the algorithms in the thread mode, the
+# algorithm not listed use the thread_num. The n-cut is not thread safe
+ALG_THREAD_NUM = {'n-cut': 1, 'n-cut-b': 1, 'n-cut-sweep': 1,
+                  'n-cut-b-sweep': 1}
+
+
 class seg:
     """
     This class segment the image using Normalized cut approach.
@@ -25,6 +35,9 @@ class seg:
         For Mean shift: data is [image, [param list]]
         For SLIC: data is [image, [param list]]
         For quickshift: [image, [kernel_size, ...]]
+        For N-Cut sweep: data is [image, label_or_num, [threshold, ...]]
+            The super pixel and the RAG are built once, and the result is
+            the [threshold num, h, w] label maps
 
     get():
         return the label image, if the out queue is empty, block
@@ -37,73 +50,130 @@ class seg:
         Check if the in queue is full
 
     start():
-        start the threads
+        start the workers
 
     readytojoin():
         If the object is ready to join
 
     join():
-        Block the thread and wait for threads to join
+        Block the thread and wait for workers to join
+
+    The cache is a seg_cache_lib.seg_cache, the cached images skip the
+    segmentation, and the new results are stored into it.
+
+    The mode is 'thread' or 'process'. Most of the skimage algorithms hold
+    the GIL, so the 'process' mode is needed to scale with the cores, the
+    images and labels are pickled to the worker processes.
     """
 
-    def __init__(self, in_queue_size=200, out_queue_size=200, thread_num=10):
+    def __init__(self, in_queue_size=200, out_queue_size=200, thread_num=10,
+                 mode='thread', process_num=None, cache=None):
         # The input is np.array
         self.inqueue = Queue.Queue(maxsize=in_queue_size)
         # The output is str
         self.outqueue = Queue.Queue(maxsize=out_queue_size)
+        if mode not in ['thread', 'process']:
+            log.error('\033[01;31mERROR\033[0m: Unknown mode %s, use thread'
+                      % mode)
+            mode = 'thread'
+        self.mode = mode
         # The number of the thread
         self.thread_num = thread_num
-        # The thread pool
-        self.thread_pool = []
-        # Signal if the threads should exit
+        # The number of the process, the cpu number if None
+        self.process_num = process_num
+        # The worker pool
+        self.pool = None
+        # The thread which collect the results from the pool in order
+        self.collector = None
+        # Limit the number of images inside the pool
+        self._pending = threading.BoundedSemaphore(in_queue_size)
+        # Signal if the workers should exit
         self._thread_state = True
-        # The wait time to copy data from in queue to in buffer
+        # The wait time to put data to the out queue before checking the
+        # thread state
         self.block_time = 5
-        self.mutex = threading.Lock()
         # Set the segment algorithm
-        self.func_seg_image = self._mean_shift
+        self.method = 'm-shift'
+        self.func_seg_image = _mean_shift
         # Indicate whether the IO is balance
         self.io_balance = 0
         # The supported segment algorithms
-        self.alg_list = ['n-cut', 'm-shift', 'slic', 'q-shift', 'n-cut-b']
+        self.alg_list = ['n-cut', 'm-shift', 'slic', 'q-shift', 'n-cut-b',
+                         'n-cut-sweep', 'n-cut-b-sweep']
         # The corresponding functions
-        self.alg_func_list = [self._ncut_seg,
-                              self._mean_shift,
-                              self._slic,
-                              self._quick_shift,
-                              self._ncutb_seg]
+        self.alg_func_list = [_ncut_seg,
+                              _mean_shift,
+                              _slic,
+                              _quick_shift,
+                              _ncutb_seg,
+                              _ncut_sweep,
+                              _ncutb_sweep]
+        # The worker number set by set_method
+        self.alg_worker_num = {}
+        # The result cache, and the [key, cached label] of the tasks in
+        # the pool, in the in order
+        self.cache = cache
+        self._cache_list = collections.deque()
 
     def start(self):
         """
-        Start the threads, which keep monitor the inqueue and try to convert
-        array to datum and to string
+        Start the workers, which keep monitor the inqueue and segment
+        the images
         """
+        worker_num = self.get_worker_num()
         # Check
-        if self.func_seg_image is self._ncut_seg and self.thread_num != 1:
+        if self.mode == 'thread' and self.method in ALG_THREAD_NUM and \
+                worker_num > ALG_THREAD_NUM[self.method]:
             log.warn('\033[0;33mWARNING\033[0m: In Ncut mode, the multithread \
 might cause problem.')
-        # Start the worker thread
-        for i in range(self.thread_num):
-            hThread = threading.Thread(
-                target=self._thread
-            )
-            hThread.start()
-            self.thread_pool.append(hThread)
-
-    def set_method(self, method):
+        self._thread_state = True
+        if self.mode == 'process':
+            self.pool = multiprocessing.Pool(worker_num)
+        else:
+            self.pool = ThreadPool(worker_num)
+        # The imap keep the order of the in queue
+        rst_iter = self.pool.imap(_seg_worker, self._task_iter())
+        self.collector = threading.Thread(target=self._collect,
+                                          args=(rst_iter,))
+        self.collector.start()
+
+    def set_method(self, method, worker_num=None):
         """
         Currently, it support
         1. normalized cut, 'n-cut'
         2. mean shift, 'm-shift'
+        3. slic, 'slic'
+        4. quick shift, 'q-shift'
+        5. normalized cut with boundary, 'n-cut-b'
+        6. threshold sweep of n-cut, 'n-cut-sweep'
+        7. threshold sweep of n-cut-b, 'n-cut-b-sweep'
+        The worker_num is the thread or process number used by the method,
+        if None, the ALG_THREAD_NUM and thread_num are used in the thread
+        mode, and process_num is used in the process mode
         """
         for name, func in zip(self.alg_list, self.alg_func_list):
             if method.lower() == name.lower():
+                self.method = name
                 self.func_seg_image = func
+                if worker_num is not None:
+                    self.alg_worker_num[name] = worker_num
                 return
         else:
             log.error('\033[31mERROR:\033[0m Currently, only support %s'
                       % str(self.alg_list))
 
+    def get_worker_num(self):
+        """
+        The worker number of the current method
+        """
+        if self.method in self.alg_worker_num:
+            return self.alg_worker_num[self.method]
+        if self.mode == 'process':
+            if self.process_num is None:
+                return multiprocessing.cpu_count()
+            return self.process_num
+        return ALG_THREAD_NUM.get(self.method, self.thread_num)
+
     def put(self, data_id, data, block=True):
         """
         Here the thread might be blocked
@@ -130,12 +200,21 @@ might cause problem.')
 
     def join(self):
         """
-        Signal the threads exit, and wait for them
+        Signal the workers exit, and wait for them
         """
         self._thread_state = False
-        for hThread in self.thread_pool:
-            hThread.join()
-        self.thread_pool = []
+        if self.pool is None:
+            return
+        # Stop the task iter
+        self.inqueue.put(None)
+        self.pool.close()
+        self.collector.join()
+        self.pool.join()
+        self.pool = None
+        self.collector = None
+        if self.cache is not None:
+            self.cache.flush()
+            self.cache.report()
 
     def get(self, block=True):
         """
@@ -150,156 +229,445 @@ might cause problem.')
             return None
         return val[0], val[1]
 
-    def _ncut_seg(self, data_list):
+    def seg_tiled(self, data, tile_size=1024, overlap=64):
         """
-        Use the ncut method to segment the image
-        [image, slic_label/[slic_param], [ncut_param]]
+        Segment a large image with the current method by the overlapping
+        tiles (see seg_tiled). The tiles are segmented by a dedicated pool
+        of the current mode and worker number, since the pool of the
+        started workers is occupied by the in queue
         """
-        img = data_list[0]
-        param = data_list[1]
-        param_cut = data_list[2]
-        if param_cut is None:
-            threahold = 0.001
+        worker_num = self.get_worker_num()
+        if self.mode == 'process':
+            pool = multiprocessing.Pool(worker_num)
         else:
-            threahold = param_cut[0]
-        # Check if the param is the super pixel label or the num of super pixel
-        # to be segmented
-        try:
-            num = int(param[0])
-            # super pixel seg
-            label1 = segmentation.slic(img, compactness=10, n_segments=num,
-                                       slic_zero=True)
-        except:
-            label1 = param
-        # N-Cut
-        g = graph.rag_mean_color(img, label1, mode='similarity')
+            pool = ThreadPool(worker_num)
         try:
-            label2 = graph.cut_normalized(label1, g, thresh=threahold)
-        except:
-            log.error('\033[01;31mERROR\033[0m: Unknow Error in cut_normalized \
-function.')
-            label2 = np.zeros(label1.shape).astype('int')
-        return label2
+            return seg_tiled(self.func_seg_image, data, tile_size, overlap,
+                             pool)
+        finally:
+            pool.close()
+            pool.join()
 
-    def _ncutb_seg(self, data_list):
-        """
-        This function use bounday instead of color to formulate the RAG
-        Use the ncut method to segment the image
-        [image, slic_label/[slic_param], [ncut_param]]
-        """
-        img = data_list[0]
-        param = data_list[1]
-        param_cut = data_list[2]
-        if param_cut is None:
-            threahold = 0.2
-        else:
-            threahold = param_cut[0]
-        # Check if the param is the super pixel label or the num of super pixel
-        # to be segmented
-        try:
-            num = int(param[0])
-            # super pixel seg
-            label1 = segmentation.slic(img, compactness=10, n_segments=num,
-                                       max_iter=100, slic_zero=True)
-        except:
-            label1 = param
-        # N-Cut
-        # Edge detection
-        edge = filters.sobel(color.rgb2gray(img))
-        # Smooth the edge map
-        edge = filters.gaussian(edge, 1)
-        edge = filters.gaussian(edge, 1)
-        # Reverse the energy map
-        ne = edge.max() - edge
-        rag = graph.rag_boundary(label1, ne)
-        label2 = graph.cut_normalized(label1, rag, thresh=threahold)
-        return label2
-
-    def _mean_shift(self, data_list):
-        """
-        The first parameter is the image
-        the second parameter is [spatial_radius, range_radius, min_density]
-        If None, the default val will be 6, 4.5, and 50
-        """
-        im = data_list[0]
-        params = data_list[1]
-        if params is None:
-            sr = 6
-            rr = 4.5
-            md = 50
-        else:
-            sr = params[0]
-            rr = params[1]
-            md = params[2]
-        (segmented_image, labels_image, number_regions) = \
-            pms.segment(im, spatial_radius=sr, range_radius=rr, min_density=md)
-        return labels_image
-
-    def _slic(self, data_list):
-        """
-        The first param image
-        Second param is [n_segments, compactness, max_iter, slic_zero]
-        """
-        im = data_list[0]
-        params = data_list[1]
-        n_seg = params[0]
-        comp = params[1]
-        max_iter = params[2]
-        slic0 = params[3]
-        enforce_conn = params[4]
-        label = segmentation.slic(im, n_segments=n_seg, compactness=comp,
-                                  enforce_connectivity=enforce_conn,
-                                  max_iter=max_iter, slic_zero=slic0)
-        return label
-
-    def _quick_shift(self, data_list):
+    def _task_iter(self):
         """
-        The first param is image
-        Second param [kernel_size, ...]
-        NOTE: If the kernel_size > 10, the speed will be very slow
+        Yield the [func, data_id, data] tasks from the in queue to the pool,
+        until the None put by join
         """
-        im = data_list[0]
-        params = data_list[1]
-        if params is None:
-            kernel_size = 5
-        else:
-            kernel_size = params[0]
-        label = segmentation.quickshift(im, kernel_size=kernel_size)
-        return label
-
-    def _fetch_data(self):
-        data_id = None
-        data = None
-        self.mutex.acquire()
-        if not self.inqueue.empty():
+        func = self.func_seg_image
+        while True:
             val = self.inqueue.get()
-            data_id = val[0]
-            data = val[1]
-        self.mutex.release()
-        return data_id, data
-
-    def _dump_data(self, data_id, data):
-        # Here might block the thread
-        while self._thread_state:
-            if self.outqueue.full():
-                # Indicate the out buf might not be flushed
-                time.sleep(0.1)
+            if val is None:
+                return
+            self._pending.acquire()
+            if self.cache is None:
+                yield func, val[0], val[1]
                 continue
-            self.outqueue.put([data_id, data])
-            break
+            key = self.cache.get_key(self.method, val[1])
+            label = self.cache.get(self.method, val[1], key)
+            self._cache_list.append([key, label])
+            if label is None:
+                yield func, val[0], val[1]
+            else:
+                # Skip the segmentation
+                yield None, val[0], None
 
-    def _thread(self):
+    def _collect(self, rst_iter):
         """
-        This is the main thread to segment the image and get the result
+        Put the results to the out queue in the in order
         """
-        while self._thread_state:
-            # Get the data
-            data_id, data = self._fetch_data()
-            if data is None or data_id is None:
-                time.sleep(0.1)
+        for data_id, rst in rst_iter:
+            if self.cache is not None:
+                key, label = self._cache_list.popleft()
+                if label is not None:
+                    rst = label
+                elif rst is not None:
+                    self.cache.put(self.method, None, rst, key)
+            # Here might block the thread
+            while self._thread_state:
+                try:
+                    self.outqueue.put([data_id, rst],
+                                      timeout=self.block_time)
+                    break
+                except Queue.Full:
+                    # Indicate the out buf might not be flushed
+                    continue
+            self._pending.release()
+
+
+def _seg_worker(task):
+    """
+    Segment one image in the worker, the func must be a module level
+    function in the process mode. If failed, the result is None
+    If the func is None, the result is cached
+    """
+    func, data_id, data = task
+    if func is None:
+        return data_id, None
+    try:
+        rst = func(data)
+    except Exception as e:
+        log.error('\033[01;31mERROR\033[0m: Failed to segment %s: %s'
+                  % (str(data_id), str(e)))
+        rst = None
+    return data_id, rst
+
+
+def seg_tiled(func, data, tile_size=1024, overlap=64, pool=None,
+              merge_thd=0.5):
+    """
+    Segment the large image by the overlapping tiles, and stitch the tile
+    labels into one label map
+    PARAM:
+        func        The segment function, e.g. _slic, see seg.alg_func_list
+        data        Same as seg.put, [image, params...], the np.ndarray
+                    param with the same height and width as the image
+                    (e.g. the pre-segmented label of n-cut) is cut as well.
+                    For slic and n-cut, the super pixel number is scaled
+                    by the tile area
+        tile_size   The height and width of the tiles
+        overlap     The overlap between the adjacent tiles
+        pool        The pool to segment the tiles, a multiprocessing.Pool
+                    (cpu number) is created if None. It must not be the
+                    pool of a started seg, whose task handler is blocked
+                    on the in queue
+        merge_thd   The labels of the adjacent tiles are merged if their
+                    IoU in the overlap region is larger than it
+    RETURN:
+        The contiguous [h, w] label map. Each pixel takes the label of the
+        tile whose center is nearer (the seam is the middle of the
+        overlap), and the labels matched across the seams are merged.
+        For the sweep functions, each threshold is stitched separately
+        and the result is [threshold num, h, w]
+    """
+    if overlap >= tile_size:
+        log.error('\033[01;31mERROR\033[0m: The overlap %d must be smaller \
+than the tile size %d' % (overlap, tile_size))
+        return None
+    img = data[0]
+    height, width = img.shape[0: 2]
+    h_starts, h_cuts = _tile_range(height, tile_size, overlap)
+    w_starts, w_cuts = _tile_range(width, tile_size, overlap)
+    task_list = []
+    for hs in h_starts:
+        for ws in w_starts:
+            task_list.append([func, [hs, ws],
+                              _tile_data(func, data, hs, ws, tile_size)])
+
+    if pool is None:
+        tmp_pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        rst_list = tmp_pool.map(_seg_worker, task_list)
+        tmp_pool.close()
+        tmp_pool.join()
+    else:
+        rst_list = pool.map(_seg_worker, task_list)
+
+    for pos, label in rst_list:
+        if label is None:
+            log.error('\033[01;31mERROR\033[0m: Failed to segment the tile \
+%s' % str(pos))
+            return None
+    # The sweep functions return [threshold num, h, w], each threshold is
+    # stitched separately
+    if rst_list[0][1].ndim == 3:
+        return np.stack([_stitch_tiles([[pos, label[i]]
+                                        for pos, label in rst_list],
+                                       h_cuts, w_cuts, merge_thd)
+                         for i in range(rst_list[0][1].shape[0])])
+    return _stitch_tiles(rst_list, h_cuts, w_cuts, merge_thd)
+
+
+def _stitch_tiles(rst_list, h_cuts, w_cuts, merge_thd):
+    """
+    Stitch the [pos, label] of the tiles (in the row major order) into
+    the contiguous [h, w] label map, see seg_tiled
+    """
+    # Make the labels of the tiles global
+    label_list = []
+    offset = 0
+    for pos, label in rst_list:
+        _, inv = np.unique(label, return_inverse=True)
+        label = inv.reshape(label.shape)
+        label_list.append(label + offset)
+        offset = int(label.max()) + offset + 1
+
+    # Match the labels in the overlap of the adjacent tiles
+    row_num = len(h_cuts) - 1
+    col_num = len(w_cuts) - 1
+    src_list = []
+    dst_list = []
+    for i in range(len(label_list)):
+        row, col = divmod(i, col_num)
+        # The right and the bottom tile
+        for j in [i + 1 if col + 1 < col_num else None,
+                  i + col_num if row + 1 < row_num else None]:
+            if j is None:
                 continue
-            # Cut the image
-            rst = self.func_seg_image(data)
+            src, dst = _match_seam(label_list[i], rst_list[i][0],
+                                   label_list[j], rst_list[j][0],
+                                   merge_thd)
+            src_list.append(src)
+            dst_list.append(dst)
+    src = np.concatenate(src_list) if src_list else np.zeros(0, np.int64)
+    dst = np.concatenate(dst_list) if dst_list else np.zeros(0, np.int64)
+    merge_graph = scipy.sparse.coo_matrix(
+        (np.ones(len(src)), (src, dst)), shape=(offset, offset))
+    _, merge_id = scipy.sparse.csgraph.connected_components(
+        merge_graph, directed=False)
+
+    # Each pixel take the label of the tile which owns it
+    height = h_cuts[-1]
+    width = w_cuts[-1]
+    rst = np.zeros([height, width], dtype=np.int64)
+    for i, label in enumerate(label_list):
+        row, col = divmod(i, col_num)
+        hs, ws = rst_list[i][0]
+        h0, h1 = h_cuts[row], h_cuts[row + 1]
+        w0, w1 = w_cuts[col], w_cuts[col + 1]
+        rst[h0: h1, w0: w1] = \
+            merge_id[label[h0 - hs: h1 - hs, w0 - ws: w1 - ws]]
+    _, rst = np.unique(rst, return_inverse=True)
+    return rst.reshape(height, width)
+
+
+def _tile_range(length, tile_size, overlap):
+    """
+    Return the start of the tiles, and the cuts of the owned ranges
+    (tile i owns [cuts[i], cuts[i + 1]])
+    """
+    if length <= tile_size:
+        return [0], [0, length]
+    # The least tiles with at least the overlap, spread evenly
+    tile_num = (length - overlap + tile_size - overlap - 1) // \
+        (tile_size - overlap)
+    starts = [idx * (length - tile_size) // (tile_num - 1)
+              for idx in range(tile_num)]
+    cuts = [0]
+    for i in range(len(starts) - 1):
+        cuts.append((starts[i + 1] + starts[i] + tile_size) // 2)
+    cuts.append(length)
+    return starts, cuts
+
+
+def _tile_data(func, data, hs, ws, tile_size):
+    """
+    Cut the data of a tile
+    """
+    img = data[0]
+    tile_data = []
+    for item in data:
+        if isinstance(item, np.ndarray) and item.ndim >= 2 and \
+                item.shape[0: 2] == img.shape[0: 2]:
+            item = item[hs: hs + tile_size, ws: ws + tile_size]
+        tile_data.append(item)
+    # The super pixel number of slic and n-cut is scaled by the tile area,
+    # the pre-segmented label of n-cut is already cut above
+    if func in _SCALED_FUNCS and \
+            isinstance(tile_data[1], (list, tuple)):
+        tile = tile_data[0]
+        params = list(tile_data[1])
+        rate = float(tile.shape[0] * tile.shape[1]) / \
+            (img.shape[0] * img.shape[1])
+        params[0] = max(1, int(params[0] * rate + 0.5))
+        tile_data[1] = params
+    return tile_data
+
+
+def _match_seam(label1, pos1, label2, pos2, merge_thd):
+    """
+    Match the global labels of two tiles in their overlap region by IoU
+    Return the matched (src, dst) label arrays
+    """
+    h0 = max(pos1[0], pos2[0])
+    h1 = min(pos1[0] + label1.shape[0], pos2[0] + label2.shape[0])
+    w0 = max(pos1[1], pos2[1])
+    w1 = min(pos1[1] + label1.shape[1], pos2[1] + label2.shape[1])
+    if h1 <= h0 or w1 <= w0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    a = label1[h0 - pos1[0]: h1 - pos1[0], w0 - pos1[1]: w1 - pos1[1]]
+    b = label2[h0 - pos2[0]: h1 - pos2[0], w0 - pos2[1]: w1 - pos2[1]]
+    a = a.ravel()
+    b = b.ravel()
+    a_ids, a_inv, a_area = np.unique(a, return_inverse=True,
+                                     return_counts=True)
+    b_ids, b_inv, b_area = np.unique(b, return_inverse=True,
+                                     return_counts=True)
+    key, inter = np.unique(a_inv.ravel() * len(b_ids) + b_inv.ravel(),
+                           return_counts=True)
+    ai, bi = np.divmod(key, len(b_ids))
+    iou = inter / (a_area[ai] + b_area[bi] - inter).astype(np.float64)
+    keep = iou > merge_thd
+    return a_ids[ai[keep]], b_ids[bi[keep]]
+
+
+def _ncut_rag(data_list):
+    """
+    Build the super pixel label and the color RAG of the n-cut
+    [image, slic_label/[slic_param], ...]
+    """
+    img = data_list[0]
+    param = data_list[1]
+    # Check if the param is the super pixel label or the num of super pixel
+    # to be segmented
+    try:
+        num = int(param[0])
+        # super pixel seg
+        label1 = segmentation.slic(img, compactness=10, n_segments=num,
+                                   slic_zero=True)
+    except:
+        label1 = param
+    g = graph.rag_mean_color(img, label1, mode='similarity')
+    return label1, g
+
+
+def _ncut_cut(label1, g, threahold):
+    try:
+        label2 = graph.cut_normalized(label1, g, thresh=threahold)
+    except:
+        log.error('\033[01;31mERROR\033[0m: Unknow Error in cut_normalized \
+function.')
+        label2 = np.zeros(label1.shape).astype('int')
+    return label2
+
+
+def _ncut_seg(data_list):
+    """
+    Use the ncut method to segment the image
+    [image, slic_label/[slic_param], [ncut_param]]
+    """
+    param_cut = data_list[2]
+    if param_cut is None:
+        threahold = 0.001
+    else:
+        threahold = param_cut[0]
+    # N-Cut
+    label1, g = _ncut_rag(data_list)
+    return _ncut_cut(label1, g, threahold)
+
+
+def _ncut_sweep(data_list):
+    """
+    Segment the image with a list of the ncut thresholds, the super pixel
+    and the RAG are built once, and each threshold cut a copy of the RAG
+    [image, slic_label/[slic_param], [threshold, ...]]
+    Return the [threshold num, h, w] label maps
+    """
+    label1, g = _ncut_rag(data_list)
+    return np.stack([_ncut_cut(label1, g.copy(), threahold)
+                     for threahold in data_list[2]])
+
+
+def _ncutb_rag(data_list):
+    """
+    Build the super pixel label and the boundary RAG of the n-cut
+    [image, slic_label/[slic_param], ...]
+    """
+    img = data_list[0]
+    param = data_list[1]
+    # Check if the param is the super pixel label or the num of super pixel
+    # to be segmented
+    try:
+        num = int(param[0])
+        # super pixel seg
+        label1 = segmentation.slic(img, compactness=10, n_segments=num,
+                                   max_iter=100, slic_zero=True)
+    except:
+        label1 = param
+    # Edge detection
+    edge = filters.sobel(color.rgb2gray(img))
+    # Smooth the edge map
+    edge = filters.gaussian(edge, 1)
+    edge = filters.gaussian(edge, 1)
+    # Reverse the energy map
+    ne = edge.max() - edge
+    rag = graph.rag_boundary(label1, ne)
+    return label1, rag
+
+
+def _ncutb_seg(data_list):
+    """
+    This function use bounday instead of color to formulate the RAG
+    Use the ncut method to segment the image
+    [image, slic_label/[slic_param], [ncut_param]]
+    """
+    param_cut = data_list[2]
+    if param_cut is None:
+        threahold = 0.2
+    else:
+        threahold = param_cut[0]
+    # N-Cut
+    label1, rag = _ncutb_rag(data_list)
+    label2 = graph.cut_normalized(label1, rag, thresh=threahold)
+    return label2
+
+
+def _ncutb_sweep(data_list):
+    """
+    The threshold sweep of _ncutb_seg, the super pixel and the boundary
+    RAG are built once, and each threshold cut a copy of the RAG
+    [image, slic_label/[slic_param], [threshold, ...]]
+    Return the [threshold num, h, w] label maps
+    """
+    label1, rag = _ncutb_rag(data_list)
+    return np.stack([graph.cut_normalized(label1, rag.copy(),
+                                          thresh=threahold)
+                     for threahold in data_list[2]])
+
+
+def _mean_shift(data_list):
+    """
+    The first parameter is the image
+    the second parameter is [spatial_radius, range_radius, min_density]
+    If None, the default val will be 6, 4.5, and 50
+    """
+    im = data_list[0]
+    params = data_list[1]
+    if params is None:
+        sr = 6
+        rr = 4.5
+        md = 50
+    else:
+        sr = params[0]
+        rr = params[1]
+        md = params[2]
+    (segmented_image, labels_image, number_regions) = \
+        pms.segment(im, spatial_radius=sr, range_radius=rr, min_density=md)
+    return labels_image
+
+
+def _slic(data_list):
+    """
+    The first param image
+    Second param is [n_segments, compactness, max_iter, slic_zero]
+    """
+    im = data_list[0]
+    params = data_list[1]
+    n_seg = params[0]
+    comp = params[1]
+    max_iter = params[2]
+    slic0 = params[3]
+    enforce_conn = params[4]
+    label = segmentation.slic(im, n_segments=n_seg, compactness=comp,
+                              enforce_connectivity=enforce_conn,
+                              max_iter=max_iter, slic_zero=slic0)
+    return label
+
+
+def _quick_shift(data_list):
+    """
+    The first param is image
+    Second param [kernel_size, ...]
+    NOTE: If the kernel_size > 10, the speed will be very slow
+    """
+    im = data_list[0]
+    params = data_list[1]
+    if params is None:
+        kernel_size = 5
+    else:
+        kernel_size = params[0]
+    label = segmentation.quickshift(im, kernel_size=kernel_size)
+    return label
+
 
-            # Put them to out buffer
-            self._dump_data(data_id, rst)
+# The functions whose first param is the super pixel number, which is
+# scaled by the tile area in seg_tiled
+_SCALED_FUNCS = [_slic, _ncut_seg, _ncutb_seg, _ncut_sweep, _ncutb_sweep]
@@ -3,16 +3,192 @@
 # This tools box contains the functions related to the segment map
 # which is as label map normally begin with 0
 import numpy as np
-import tools
+import scipy.sparse
+import scipy.sparse.csgraph
 import glog as log
 import pdb
 
 
-def get_neighbor_ids(segmap, label):
+class SegmapIndex:
+    """
+    The index of a segmap, it is built once by a stable argsort and
+    bincount, instead of np.where(segmap == label) for every label.
+    The pixels of each label are stored in CSR style:
+        order[indptr[label]: indptr[label + 1]] are the flat pixel ids
+        of the label, in raster order (same as np.where)
+
+    Attributes:
+        shape       The shape of the segmap
+        label_num   The label number (max label + 1)
+        counts      The pixel number of each label
+        centroids   The [label_num, 2] mean (h, w) of each label
+        bboxes      The [label_num, 4] (h_min, h_max, w_min, w_max)
+    The adjacency (see build_adjacency) is built when it is first used.
+    NOTE:
+        The label which has no pixel get count 0, and its centroid and
+        bbox are 0.
+    """
+    def __init__(self, segmap, label_num=None, connectivity=8):
+        """
+        The label_num can be larger than the max label + 1, e.g. the
+        length of the superpixel vector
+        The connectivity (4 or 8) is used by the adjacency
+        """
+        segmap = np.asarray(segmap)
+        self.shape = segmap.shape
+        flat = segmap.ravel()
+        if label_num is None or label_num < int(flat.max()) + 1:
+            label_num = int(flat.max()) + 1
+        self.label_num = label_num
+        self.counts = np.bincount(flat, minlength=label_num)
+        self.indptr = np.zeros(label_num + 1, dtype=np.int64)
+        np.cumsum(self.counts, out=self.indptr[1:])
+        self.order = np.argsort(flat, kind='stable')
+        # The sorted coords of the pixels
+        self.h_sorted, self.w_sorted = np.divmod(self.order, self.shape[1])
+
+        # The centroids
+        h_sum = np.bincount(flat, weights=np.repeat(
+            np.arange(self.shape[0], dtype=np.float64), self.shape[1]),
+            minlength=label_num)
+        w_sum = np.bincount(flat, weights=np.tile(
+            np.arange(self.shape[1], dtype=np.float64), self.shape[0]),
+            minlength=label_num)
+        valid = self.counts > 0
+        self.centroids = np.zeros([label_num, 2])
+        self.centroids[valid, 0] = h_sum[valid] / self.counts[valid]
+        self.centroids[valid, 1] = w_sum[valid] / self.counts[valid]
+
+        # The bboxes, reduceat only on the non-empty labels
+        self.bboxes = np.zeros([label_num, 4], dtype=np.int64)
+        if valid.any():
+            start = self.indptr[:-1][valid]
+            self.bboxes[valid, 0] = np.minimum.reduceat(self.h_sorted, start)
+            self.bboxes[valid, 1] = np.maximum.reduceat(self.h_sorted, start)
+            self.bboxes[valid, 2] = np.minimum.reduceat(self.w_sorted, start)
+            self.bboxes[valid, 3] = np.maximum.reduceat(self.w_sorted, start)
+
+        self._segmap = segmap
+        self.connectivity = connectivity
+        self._adj_indptr = None
+        self._adj_indices = None
+
+    def pixels(self, label):
+        """
+        Return the (h_list, w_list) of the label, same as
+        np.where(segmap == label)
+        """
+        start = self.indptr[label]
+        end = self.indptr[label + 1]
+        return self.h_sorted[start: end], self.w_sorted[start: end]
+
+    def central_coords(self):
+        """
+        The rounded centroids, same as get_central_coord of each label
+        """
+        return np.floor(self.centroids + 0.5)
+
+    def central_coord(self, label):
+        coord = self.central_coords()[label]
+        return coord[0], coord[1]
+
+    def neighbors(self, label):
+        """
+        Return the sorted neighbor labels of the label
+        """
+        self._build_adjacency()
+        return self._adj_indices[self._adj_indptr[label]:
+                                 self._adj_indptr[label + 1]]
+
+    def adjacency(self):
+        """
+        Return the adjacency list in CSR style (indptr, indices)
+        """
+        self._build_adjacency()
+        return self._adj_indptr, self._adj_indices
+
+    def _build_adjacency(self):
+        if self._adj_indptr is not None:
+            return
+        adj = build_adjacency(self._segmap, self.connectivity, sparse=True,
+                              label_num=self.label_num)
+        self._adj_indptr = adj.indptr
+        self._adj_indices = adj.indices
+
+
+def _adjacent_label_pairs(segmap, connectivity=8):
+    """
+    Compare the segmap with its shifted copies, and return the (src, dst)
+    label arrays of the adjacent pixel pairs with different labels
+    """
+    segmap = np.asarray(segmap).astype(np.int64)
+    # right, down
+    shift_list = [(segmap[:, :-1], segmap[:, 1:]),
+                  (segmap[:-1, :], segmap[1:, :])]
+    if connectivity == 8:
+        # down right, down left
+        shift_list += [(segmap[:-1, :-1], segmap[1:, 1:]),
+                       (segmap[:-1, 1:], segmap[1:, :-1])]
+    src_list = []
+    dst_list = []
+    for a, b in shift_list:
+        diff = a != b
+        src_list.append(a[diff])
+        dst_list.append(b[diff])
+    return np.concatenate(src_list), np.concatenate(dst_list)
+
+
+def build_adjacency(segmap, connectivity=8, return_length=False,
+                    sparse=False, label_num=None):
+    """
+    Build the region adjacency graph of the segmap by comparing it with
+    its shifted copies once, instead of per label.
+    PARAM:
+        connectivity    4 or 8
+        return_length   If True, also return the boundary length of each
+                        edge, which is the number of adjacent pixel pairs
+        sparse          If True, return the symmetric [label_num,
+                        label_num] scipy csr matrix, the value is the
+                        boundary length. The neighbors of label i are
+                        adj.indices[adj.indptr[i]: adj.indptr[i + 1]]
+        label_num       The label number, default is max label + 1
+    RETURN:
+        If not sparse, return the [n, 2] edge array (small label first),
+        and the [n] boundary length array if return_length is True
+    """
+    if connectivity not in [4, 8]:
+        log.error('\033[01;31mERROR\033[0m: The connectivity must be 4 or 8')
+        return None
+    segmap = np.asarray(segmap)
+    if label_num is None or label_num < int(segmap.max()) + 1:
+        label_num = int(segmap.max()) + 1
+    src, dst = _adjacent_label_pairs(segmap, connectivity)
+    key = np.minimum(src, dst) * label_num + np.maximum(src, dst)
+    key, length = np.unique(key, return_counts=True)
+    edges = np.stack([key // label_num, key % label_num], axis=1)
+
+    if sparse:
+        adj = scipy.sparse.coo_matrix(
+            (np.concatenate([length, length]),
+             (np.concatenate([edges[:, 0], edges[:, 1]]),
+              np.concatenate([edges[:, 1], edges[:, 0]]))),
+            shape=(label_num, label_num)).tocsr()
+        adj.sort_indices()
+        return adj
+    if return_length:
+        return edges, length
+    return edges
+
+
+def get_neighbor_ids(segmap, label, index=None):
     """
     Given the current superpixel label, and return the label list which is
     the neighbor superpixels
+    If the SegmapIndex of the segmap is given, use it instead of scanning
+    the segmap
     """
+    if index is not None:
+        return index.neighbors(label).tolist()
     max_h = segmap.shape[0] - 1
     max_w = segmap.shape[1] - 1
     pos_hw = np.where(segmap == label)
@@ -54,10 +230,12 @@ def get_neighbor_ids(segmap, label):
     return combine
 
 
-def check_if_neighbor(segmap, label1, label2):
+def check_if_neighbor(segmap, label1, label2, index=None):
     """
     Check if two superpixel blocks are nearby each other
     """
+    if index is not None:
+        return label1 == label2 or label2 in index.neighbors(label1)
     max_h = segmap.shape[0] - 1
     max_w = segmap.shape[1] - 1
 
@@ -99,10 +277,12 @@ def check_if_neighbor(segmap, label1, label2):
     return False
 
 
-def get_central_coord(segmap, label):
+def get_central_coord(segmap, label, index=None):
     """
     Get the central coordinate of a certain superpixel
     """
+    if index is not None:
+        return index.central_coord(label)
     pos_hw = np.where(segmap == label)
 
     label_h_list = pos_hw[0]
@@ -111,27 +291,47 @@ def get_central_coord(segmap, label):
     return round(label_h_list.mean()), round(label_w_list.mean())
 
 
-def superpixel_unpool(segmap, vec):
+def superpixel_unpool(segmap, vec, out=None, batch=False):
     """
     Unpooling the vec into the segment image
     The size of the vec must equal with the number of the superpixels
     The vec can be a [n] dim vec, or can be a [n, c] image, the c indicate
     the channels
+    The unpooling is a single gather vec[segmap], so the cost is one pass
+    over the image no matter how many superpixels there are.
+    PARAM:
+        out     The output buffer [h, w] or [h, w, c] ([b, ...] if batch),
+                the vec is converted to its dtype
+        batch   If True, the vec is [b, n] or [b, n, c], which is a batch
+                of vectors share the same segmap, the result is
+                [b, h, w] or [b, h, w, c]
+    NOTE:
+        The pixels whose label is out of the vec are set to 0
     """
-    vec = np.array(vec)
-    if vec.ndim == 1:
-        return superpixel_unpool_channel(segmap, vec)
-    if vec.ndim > 2:
+    vec = np.asarray(vec)
+    if batch:
+        axis = 1
+    else:
+        axis = 0
+    if vec.ndim - axis > 2:
         log.error('\033[01;31mERROR\033[0m: The channel must be \
 smaller than 2')
         return
-    rst = np.zeros([segmap.shape[0], segmap.shape[1], vec.shape[1]])
-    for i in range(vec.shape[1]):
-        rst[:, :, i] = superpixel_unpool_channel(segmap, vec[:, i])
-    return rst
-
-
-def superpixel_unpool_channel(segmap, vec):
+    if out is None:
+        vec = vec.astype(np.float64, copy=False)
+    else:
+        vec = vec.astype(out.dtype, copy=False)
+    label_num = vec.shape[axis]
+    if segmap.max() >= label_num:
+        # The labels without value get 0
+        pad_shape = list(vec.shape)
+        pad_shape[axis] = int(segmap.max()) + 1 - label_num
+        vec = np.concatenate([vec, np.zeros(pad_shape, dtype=vec.dtype)],
+                             axis=axis)
+    return np.take(vec, segmap, axis=axis, out=out)
+
+
+def superpixel_unpool_channel(segmap, vec, out=None):
     """
     Only can unpool a one channel image
     """
@@ -139,14 +339,81 @@ def superpixel_unpool_channel(segmap, vec):
         log.error('\033[01;31mERROR\033[0m: The channels must be 1')
         return
 
-    rst = np.zeros(segmap.shape)
-    for i in range(len(vec)):
-        rst[segmap == i] = vec[i]
+    return superpixel_unpool(segmap, vec, out)
+
+
+def superpixel_pool(segmap, featmap, op='mean', index=None, batch=False):
+    """
+    The inverse of the superpixel_unpool, pool the dense featmap into one
+    vector per superpixel by reducing over the label sorted pixels
+    (see SegmapIndex), without python loop over the labels.
+    PARAM:
+        featmap     [h, w] or [h, w, c] featmap, ([b, ...] if batch)
+        op          mean, max, min, median or std
+        index       The SegmapIndex of the segmap, built if None
+        batch       If True, the featmap is a batch share the same segmap
+    RETURN:
+        [n] or [n, c] array ([b, ...] if batch), the n is the label number
+        The label without pixel gets 0
+    """
+    if op not in ['mean', 'max', 'min', 'median', 'std']:
+        log.error('\033[01;31mERROR\033[0m: Unknown pooling op %s' % op)
+        return None
+    if index is None:
+        index = SegmapIndex(segmap)
+    featmap = np.asarray(featmap)
+    if not batch:
+        featmap = featmap[np.newaxis]
+    single_channel = featmap.ndim == 3
+    if single_channel:
+        featmap = featmap[:, :, :, np.newaxis]
+    b, h, w, c = featmap.shape
+
+    # The [b, pixel, c] values sorted by the label
+    vals = featmap.reshape(b, h * w, c)[:, index.order, :]
+    vals = vals.astype(np.float64)
+    valid = index.counts > 0
+    start = index.indptr[:-1][valid]
+    counts = index.counts[valid][np.newaxis, :, np.newaxis]
+    rst = np.zeros([b, index.label_num, c])
+
+    if op == 'mean' or op == 'std':
+        mean = np.add.reduceat(vals, start, axis=1) / counts
+        if op == 'mean':
+            rst[:, valid, :] = mean
+        else:
+            rst[:, valid, :] = mean
+            label_sorted = np.repeat(np.arange(index.label_num),
+                                     index.counts)
+            dev = vals - rst[:, label_sorted, :]
+            dev *= dev
+            rst[:, valid, :] = np.sqrt(
+                np.add.reduceat(dev, start, axis=1) / counts)
+    elif op == 'max':
+        rst[:, valid, :] = np.maximum.reduceat(vals, start, axis=1)
+    elif op == 'min':
+        rst[:, valid, :] = np.minimum.reduceat(vals, start, axis=1)
+    else:
+        # Sort the values within each label, and pick the middle ones
+        label_sorted = np.repeat(np.arange(index.label_num), index.counts)
+        cnt = index.counts[valid]
+        lo = start + (cnt - 1) // 2
+        hi = start + cnt // 2
+        for bi in range(b):
+            for ci in range(c):
+                val = vals[bi, :, ci]
+                val = val[np.lexsort((val, label_sorted))]
+                rst[bi, valid, ci] = (val[lo] + val[hi]) / 2.0
+
+    if single_channel:
+        rst = rst[:, :, 0]
+    if not batch:
+        rst = rst[0]
     return rst
 
 
 def superpixel_unpool_with_normal(segmap, dep_vec, norm_vec, fx, fy,
-                                  boundary=0):
+                                  boundary=0, index=None, batch=False):
     """
     This function is an extend version of the superpixel_unpool
     This function will take the normal vector direction into consideration
@@ -158,55 +425,66 @@ def superpixel_unpool_with_normal(segmap, dep_vec, norm_vec, fx, fy,
         norm_vec    The normal vector corresponding to each superpixel
         fx          The focal length (in pixel) of col
         fy          The focal length (in pixel) of row
+        index       The SegmapIndex of the segmap, built if None
+        batch       If True, the dep_vec is [b, n] and the norm_vec is
+                    [b, n, 3], which share the same segmap, and the
+                    result is [b, h, w]
     NOTE:
         Different from the superpixel_unpool function, this function
         can only produce the depth map that means the channel of the
         dep_vec must be one
+        The plane of each superpixel is evaluated over the whole image in
+        one pass: the per-label params are gathered by the label map.
     """
-    dep_vec = np.array(dep_vec)
-    norm_vec = np.array(norm_vec)
-    if dep_vec.ndim > 1:
+    dep_vec = np.array(dep_vec, dtype=np.float64)
+    norm_vec = np.array(norm_vec, dtype=np.float64)
+    if not batch:
+        dep_vec = dep_vec[np.newaxis]
+        norm_vec = norm_vec[np.newaxis]
+    if dep_vec.ndim > 2:
         log.error('\033[01;31mERROR\033[0m: The channel number of dep \
 vec must be 1')
         return
 
-    if norm_vec.ndim != 2:
+    if norm_vec.ndim != 3:
         log.error('\033[01;31mERROR\033[0m: The channel number of norm \
 vec must be 2')
         return
 
-    dep_map = np.zeros(segmap.shape)
-
-    # Iter the superpixel
-    for i in range(len(dep_vec)):
-        # The normal vector of the superpixel
-        norm = norm_vec[i, :]
-        # TODO: The Z is reversed
-        dx = -norm[0] / abs(norm[2])
-        dy = -norm[1] / abs(norm[2])
-        # Get the pixel location of the current superpixel
-        pos_hw = np.where(segmap == i)
-
-        label_h_list = pos_hw[0]
-        label_w_list = pos_hw[1]
-        h_central = round(label_h_list.mean())
-        w_central = round(label_w_list.mean())
-
-        curr_dep = dep_vec[i]
-
-        # Iter the pixels
-        for h, w in zip(label_h_list, label_w_list):
-            ph_diff = h - h_central
-            pw_diff = w - w_central
-            h_diff = ph_diff * curr_dep / fy
-            w_diff = pw_diff * curr_dep / fx
-            pred_dep = curr_dep + dx * w_diff + dy * h_diff
-            if boundary != 0:
-                rate = pred_dep / curr_dep
-                if rate > 1 + boundary or rate < 1 - boundary:
-                    pred_dep = curr_dep
-            dep_map[h, w] = pred_dep
-
+    label_num = dep_vec.shape[1]
+    if index is None:
+        index = SegmapIndex(segmap, label_num)
+    center = index.central_coords()[0: label_num]
+
+    # The plane of each superpixel:
+    # pred = dep + dx * (w - w_c) * dep / fx + dy * (h - h_c) * dep / fy
+    #      = base + w_coef * w + h_coef * h
+    # TODO: The Z is reversed
+    dx = -norm_vec[:, :, 0] / np.abs(norm_vec[:, :, 2])
+    dy = -norm_vec[:, :, 1] / np.abs(norm_vec[:, :, 2])
+    w_coef = dx * dep_vec / fx
+    h_coef = dy * dep_vec / fy
+    base = dep_vec - w_coef * center[:, 1] - h_coef * center[:, 0]
+
+    # The pixels whose label is out of the dep_vec remain 0
+    label_map = np.asarray(segmap)
+    valid = label_map < label_num
+    label_map = np.where(valid, label_map, 0)
+    h_map, w_map = np.indices(label_map.shape)
+
+    curr_dep = np.take(dep_vec, label_map, axis=1)
+    dep_map = np.take(base, label_map, axis=1)
+    dep_map += np.take(w_coef, label_map, axis=1) * w_map
+    dep_map += np.take(h_coef, label_map, axis=1) * h_map
+    if boundary != 0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = dep_map / curr_dep
+        out_range = (rate > 1 + boundary) | (rate < 1 - boundary)
+        dep_map = np.where(out_range, curr_dep, dep_map)
+    dep_map *= valid
+
+    if not batch:
+        return dep_map[0]
     return dep_map
 
 
@@ -214,7 +492,9 @@ def superpixel_unpool_with_interp(segmap,
                                   dep_vec,
                                   norm_vec,
                                   rad_thd,
-                                  dep_map=None):
+                                  dep_map=None,
+                                  index=None,
+                                  edges=None):
     """
     This is another version of the superpixel_unpool.
     This version use interpolation to make the depth map smoother.
@@ -225,6 +505,8 @@ def superpixel_unpool_with_interp(segmap,
         this function support the predefined dep map. If the dep_map param
         is set, it will be considered as the default depth if a superpixel
         is not connected with others
+        The index is the SegmapIndex of the segmap, built if None
+        The edges are the coplanar_edges, calculated if None
     """
     dep_vec = np.array(dep_vec)
     norm_vec = np.array(norm_vec)
@@ -244,75 +526,106 @@ vec must be 2')
     else:
         predefined = True
 
-    # Calc the central points of each superpixel
-    central_points_list = []
-    for i in range(len(dep_vec)):
-        h_central, w_central = get_central_coord(segmap, i)
-        central_points_list.append([h_central, w_central])
+    if index is None:
+        index = SegmapIndex(segmap, len(dep_vec))
+
+    # Judge if the neighbor superpixel are in the same plane
+    if edges is None:
+        edges = coplanar_edges(segmap, dep_vec, norm_vec, rad_thd,
+                               index=index)
+    global_neighbor_list = _coplanar_neighbor_list(edges, len(dep_vec))
+
+    _interp_in_groups(index, dep_vec, global_neighbor_list, dep_map,
+                      predefined)
+    return dep_map
 
-    # Iter the superpixels
-    global_neighbor_list = []
-    for i in range(len(dep_vec)):
-        neighbor_list = get_neighbor_ids(segmap, i)
-        # Judge if the neighbor superpixel are in the same plan
-        group = []
-        for neighbor in neighbor_list:
-            if _is_same_plane(norm_vec[i, :], norm_vec[neighbor, :], rad_thd):
-                group.append(neighbor)
-        global_neighbor_list.append(group)
 
-    # Extend the neighbor list, that means the patches will be not be only
-    # connected to the neighbor superpixel, but also the pathes which its
-    # neighbor are connected
+def _interp_in_groups(index, dep_vec, global_neighbor_list, dep_map,
+                      predefined):
+    """
+    The interpolation engine of superpixel_unpool_with_interp(_ex).
+    For each superpixel, the nearest 'four corner' central points of all
+    its pixels are found at once (see _get_surrounding_points_batch), and
+    the inverse distance weights are calculated as array operations.
+    The result is written into dep_map.
+    """
+    central_points = index.central_coords()
     for i in range(len(dep_vec)):
         neighbor_list = global_neighbor_list[i]
-        ext_neighbor_list = []
-        ext_neighbor_list.extend(neighbor_list)
+        # Extend the neighbor list, that means the patches will be not be
+        # only connected to the neighbor superpixel, but also the pathes
+        # which its neighbor are connected
+        ext_neighbor_list = list(neighbor_list)
         for neighbor in neighbor_list:
             ext_neighbor_list.extend(global_neighbor_list[neighbor])
         # Add itself
         ext_neighbor_list.append(i)
         ext_neighbor_list = np.unique(ext_neighbor_list)
 
-        dep = dep_vec[i]
-
-        if neighbor_list == []:
-            if predefined:
-                continue
-            dep_map[segmap == i] = dep
+        label_h_list, label_w_list = index.pixels(i)
+        if len(neighbor_list) == 0:
+            if not predefined:
+                dep_map[label_h_list, label_w_list] = dep_vec[i]
+            continue
+        if len(label_h_list) == 0:
             continue
 
-        # Build the corresponding central points list
-        local_central_points_list = []
-        for neighbor in ext_neighbor_list:
-            local_central_points_list.append(central_points_list[neighbor])
-
-        # Iter the all pixels in the current superpixel
-        pos_hw = np.where(segmap == i)
-
-        label_h_list = pos_hw[0]
-        label_w_list = pos_hw[1]
-
-        for h, w in zip(label_h_list, label_w_list):
-            # Search the nearist 'four corner' central points
-            points_list, id_list = \
-                _get_surrounding_points([h, w], local_central_points_list,
-                                        ext_neighbor_list)
-
-            dist_list = []
-            dep_list = []
-            for center, idd in zip(points_list, id_list):
-                dist_list.append(_dist([h, w], center))
-                dep_list.append(dep_vec[idd])
-
-            dist_list = np.array(dist_list)
-            dist_sum = dist_list.sum()
-            weight_list = dist_sum - dist_list
-            weight_list = weight_list / weight_list.sum()
-            # Perform the interpolation
-            interp_val = np.dot(weight_list, dep_list)
-            dep_map[h, w] = interp_val
-    return dep_map
+        # [pixel, 4] the surrounding points, the distance and the mask
+        sel_id, sel_dist, sel_mask = _get_surrounding_points_batch(
+            label_h_list, label_w_list, central_points[ext_neighbor_list],
+            ext_neighbor_list)
+        sel_dist = sel_dist * sel_mask
+        dist_sum = sel_dist.sum(axis=1, keepdims=True)
+        weight = (dist_sum - sel_dist) * sel_mask
+        weight = weight / weight.sum(axis=1, keepdims=True)
+        dep_map[label_h_list, label_w_list] = \
+            (weight * dep_vec[sel_id]).sum(axis=1)
+
+
+def _get_surrounding_points_batch(h_list, w_list, points, id_list):
+    """
+    The vectorized version of _get_surrounding_points for all the pixels
+    [h_list, w_list], the points is the [k, 2] central points.
+    Return three [pixel, 4] arrays: the ids and the distances of the
+    top, bottom, left and right points, and the mask indicates whether
+    the point is found.
+    NOTE:
+        The selection is exactly the same as _get_surrounding_points,
+        including that the excluded distance is marked by the index in
+        the candidate list.
+    """
+    h_list = np.asarray(h_list, dtype=np.float64)[:, np.newaxis]
+    w_list = np.asarray(w_list, dtype=np.float64)[:, np.newaxis]
+    id_list = np.asarray(id_list)
+    pixel_num = h_list.shape[0]
+    rows = np.arange(pixel_num)
+    dist = np.sqrt((h_list - points[:, 0]) ** 2 +
+                   (w_list - points[:, 1]) ** 2)
+    curr_dist = dist.copy()
+    # top, bottom, left, right
+    cand_list = [points[:, 0] <= h_list,
+                 points[:, 0] > h_list,
+                 points[:, 1] <= w_list,
+                 points[:, 1] > w_list]
+
+    sel_id = np.zeros([pixel_num, 4], dtype=np.int64)
+    sel_dist = np.zeros([pixel_num, 4])
+    sel_mask = np.zeros([pixel_num, 4])
+    for k, cand in enumerate(cand_list):
+        found = cand.any(axis=1)
+        masked = np.where(cand, curr_dist, np.inf)
+        idx = masked.argmin(axis=1)
+        # If all candidates are excluded, take the first candidate
+        all_inf = np.isinf(masked[rows, idx])
+        idx[all_inf] = cand[all_inf].argmax(axis=1)
+        sel_id[:, k] = id_list[idx]
+        sel_dist[:, k] = dist[rows, idx]
+        sel_mask[:, k] = found
+        if k < 3:
+            # The index in the candidate list
+            cand_idx = np.cumsum(cand, axis=1)[rows, idx] - 1
+            curr_dist[rows[found], cand_idx[found]] = np.inf
+    return sel_id, sel_dist, sel_mask
 
 
 def _is_same_plane(norm1, norm2, thd):
@@ -430,7 +743,9 @@ def superpixel_unpool_with_interp_ex(segmap,
                                      rad_thd,
                                      fx,
                                      fy,
-                                     dep_map=None):
+                                     dep_map=None,
+                                     index=None,
+                                     edges=None):
     """
     Different from the superpixel_unpool_with_interp, this function take both
     normal and depth into consideration to judge whether the superpixel are
@@ -445,6 +760,8 @@ def superpixel_unpool_with_interp_ex(segmap,
         this function support the predefined dep map. If the dep_map param
         is set, it will be considered as the default depth if a superpixel
         is not connected with others
+        The index is the SegmapIndex of the segmap, built if None
+        The edges are the coplanar_edges, calculated if None
     """
     dep_vec = np.array(dep_vec)
     norm_vec = np.array(norm_vec)
@@ -464,81 +781,17 @@ vec must be 2')
     else:
         predefined = True
 
-    # Calc the central points of each superpixel
-    central_points_list = []
-    for i in range(len(dep_vec)):
-        h_central, w_central = get_central_coord(segmap, i)
-        central_points_list.append([h_central, w_central])
-
-    # Iter the superpixels
-    global_neighbor_list = []
-    for i in range(len(dep_vec)):
-        neighbor_list = get_neighbor_ids(segmap, i)
-        # Judge if the neighbor superpixel are in the same plan
-        group = []
-        for neighbor in neighbor_list:
-            if _is_same_plane_ex(norm_vec[i, :], norm_vec[neighbor, :],
-                                 dep_vec[i], dep_vec[neighbor],
-                                 central_points_list[i],
-                                 central_points_list[neighbor],
-                                 fx,
-                                 fy,
-                                 rad_thd,
-                                 rad_thd):
-                group.append(neighbor)
-        global_neighbor_list.append(group)
-
-    # Extend the neighbor list, that means the patches will be not be only
-    # connected to the neighbor superpixel, but also the pathes which its
-    # neighbor are connected
-    for i in range(len(dep_vec)):
-        neighbor_list = global_neighbor_list[i]
-        ext_neighbor_list = []
-        ext_neighbor_list.extend(neighbor_list)
-        for neighbor in neighbor_list:
-            ext_neighbor_list.extend(global_neighbor_list[neighbor])
-        # Add itself
-        ext_neighbor_list.append(i)
-        ext_neighbor_list = np.unique(ext_neighbor_list)
-
-        dep = dep_vec[i]
+    if index is None:
+        index = SegmapIndex(segmap, len(dep_vec))
 
-        if neighbor_list == []:
-            if predefined:
-                continue
-            dep_map[segmap == i] = dep
-            continue
+    # Judge if the neighbor superpixel are in the same plane
+    if edges is None:
+        edges = coplanar_edges(segmap, dep_vec, norm_vec, rad_thd, fx, fy,
+                               index)
+    global_neighbor_list = _coplanar_neighbor_list(edges, len(dep_vec))
 
-        # Build the corresponding central points list
-        local_central_points_list = []
-        for neighbor in ext_neighbor_list:
-            local_central_points_list.append(central_points_list[neighbor])
-
-        # Iter the all pixels in the current superpixel
-        pos_hw = np.where(segmap == i)
-
-        label_h_list = pos_hw[0]
-        label_w_list = pos_hw[1]
-
-        for h, w in zip(label_h_list, label_w_list):
-            # Search the nearist 'four corner' central points
-            points_list, id_list = \
-                _get_surrounding_points([h, w], local_central_points_list,
-                                        ext_neighbor_list)
-
-            dist_list = []
-            dep_list = []
-            for center, idd in zip(points_list, id_list):
-                dist_list.append(_dist([h, w], center))
-                dep_list.append(dep_vec[idd])
-
-            dist_list = np.array(dist_list)
-            dist_sum = dist_list.sum()
-            weight_list = dist_sum - dist_list
-            weight_list = weight_list / weight_list.sum()
-            # Perform the interpolation
-            interp_val = np.dot(weight_list, dep_list)
-            dep_map[h, w] = interp_val
+    _interp_in_groups(index, dep_vec, global_neighbor_list, dep_map,
+                      predefined)
     return dep_map
 
 
@@ -576,13 +829,109 @@ def _is_same_plane_ex(norm1, norm2, dep1, dep2, center1, center2,
         return False
 
 
-def get_border_pixels(segmap, label):
+def _angle_batch(vec1, vec2):
+    """
+    The vectorized _angle of the [n, k] vector arrays row by row.
+    Same as _angle, the angle of a zero vector is pi
+    """
+    val = (vec1 * vec2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = val / np.linalg.norm(vec1, axis=1) / np.linalg.norm(vec2, axis=1)
+    c = np.where(np.isnan(c), -1, np.clip(c, -1, 1))
+    return np.arccos(c)
+
+
+def coplanar_edges(segmap, dep_vec, norm_vec, rad_thd, fx=None, fy=None,
+                   index=None):
+    """
+    Judge all the adjacency edges of the superpixels at once, and return
+    the [m, 2] edges (small label first) which are in the same plane.
+    If fx and fy are None, the edge is judged by the normal angle, same as
+    _is_same_plane, otherwise both the normal and the depth are used, same
+    as _is_same_plane_ex (rad_thd is used for both thresholds).
+    The index is the SegmapIndex of the segmap, built if None
+    """
+    dep_vec = np.asarray(dep_vec, dtype=np.float64)
+    norm_vec = np.asarray(norm_vec, dtype=np.float64)
+    label_num = len(dep_vec)
+    if index is None:
+        index = SegmapIndex(segmap, label_num)
+
+    indptr, indices = index.adjacency()
+    src = np.repeat(np.arange(index.label_num), np.diff(indptr))
+    keep = (src < indices) & (indices < label_num)
+    edges = np.stack([src[keep], indices[keep]], axis=1)
+    n1 = norm_vec[edges[:, 0]]
+    n2 = norm_vec[edges[:, 1]]
+    ang_norm = _angle_batch(n1, n2)
+    if fx is None or fy is None:
+        return edges[ang_norm < rad_thd]
+
+    # The vector between the two superpixels in the real length
+    centers = index.central_coords()
+    d1 = dep_vec[edges[:, 0]]
+    d2 = dep_vec[edges[:, 1]]
+    dp = centers[edges[:, 0]] - centers[edges[:, 1]]
+    dep_avg = (d1 + d2) / 2
+    vec = np.stack([dep_avg * dp[:, 1] / fx,
+                    dep_avg * dp[:, 0] / fy,
+                    d1 - d2], axis=1)
+    ang = _angle_batch(vec, n1 + n2)
+    same = ~(ang_norm > rad_thd) & (np.abs(ang - 3.1416 / 2) < rad_thd)
+    return edges[same]
+
+
+def plane_segmentation(segmap, dep_vec, norm_vec, rad_thd, fx=None, fy=None,
+                       index=None, edges=None):
+    """
+    Merge the coplanar superpixels (see coplanar_edges) into planes, the
+    superpixels connected by coplanar edges are merged transitively.
+    The edges can be the pre-calculated coplanar_edges, so the grouping
+    is calculated once per image and shared by the interpolation and the
+    plane fitting.
+    Return the [len(dep_vec)] plane id of each superpixel and the plane
+    number, the plane ids are ordered by their smallest superpixel label.
+    The plane map is superpixel_unpool(segmap, plane_ids)
+    """
+    label_num = len(dep_vec)
+    if edges is None:
+        edges = coplanar_edges(segmap, dep_vec, norm_vec, rad_thd, fx, fy,
+                               index)
+    # The connected components of the coplanar graph is the union-find
+    # result of all the edges
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(edges)), (edges[:, 0], edges[:, 1])),
+        shape=(label_num, label_num))
+    plane_num, plane_ids = scipy.sparse.csgraph.connected_components(
+        graph, directed=False)
+    return plane_ids, plane_num
+
+
+def _coplanar_neighbor_list(edges, label_num):
+    """
+    Convert the coplanar edges to the sorted neighbor list of each label
+    """
+    adj = scipy.sparse.coo_matrix(
+        (np.ones(2 * len(edges)),
+         (np.concatenate([edges[:, 0], edges[:, 1]]),
+          np.concatenate([edges[:, 1], edges[:, 0]]))),
+        shape=(label_num, label_num)).tocsr()
+    adj.sort_indices()
+    return [adj.indices[adj.indptr[i]: adj.indptr[i + 1]].tolist()
+            for i in range(label_num)]
+
+
+def get_border_pixels(segmap, label, index=None):
     """
     Given a segmap and the label, get the border pixels of the superpixel
+    Use border_pixels_by_label to get the border pixels of all labels
     """
-    pixel_list = np.where(segmap == label)
-    h_list = pixel_list[0]
-    w_list = pixel_list[1]
+    if index is not None:
+        h_list, w_list = index.pixels(label)
+    else:
+        pixel_list = np.where(segmap == label)
+        h_list = pixel_list[0]
+        w_list = pixel_list[1]
     rst_list = []
     height = segmap.shape[0]
     width = segmap.shape[1]
@@ -604,8 +953,150 @@ def get_border_pixels(segmap, label):
     return rst_list
 
 
+def boundary_map(segmap, connectivity=8):
+    """
+    Return the [h, w] bool boundary mask of the segmap, a pixel is on the
+    boundary if any of its 4 or 8 neighbors has a different label.
+    The pixels out of the image are considered as the same label, which
+    is the same as get_border_pixels when connectivity is 8
+    """
+    if connectivity not in [4, 8]:
+        log.error('\033[01;31mERROR\033[0m: The connectivity must be 4 or 8')
+        return None
+    segmap = np.asarray(segmap)
+    rst = np.zeros(segmap.shape, dtype=bool)
+    # Compare with the shifted copy, and mark both sides of the pair
+    diff = segmap[:, :-1] != segmap[:, 1:]
+    rst[:, :-1] |= diff
+    rst[:, 1:] |= diff
+    diff = segmap[:-1, :] != segmap[1:, :]
+    rst[:-1, :] |= diff
+    rst[1:, :] |= diff
+    if connectivity == 8:
+        diff = segmap[:-1, :-1] != segmap[1:, 1:]
+        rst[:-1, :-1] |= diff
+        rst[1:, 1:] |= diff
+        diff = segmap[:-1, 1:] != segmap[1:, :-1]
+        rst[:-1, 1:] |= diff
+        rst[1:, :-1] |= diff
+    return rst
+
+
+def border_pixels_by_label(segmap, connectivity=8, label_num=None):
+    """
+    Get the border pixels of all the labels in one pass.
+    RETURN:
+        (indptr, h_list, w_list) in CSR style, the border pixels of label
+        are h_list[indptr[label]: indptr[label + 1]] (and w_list), in the
+        raster order, same as get_border_pixels
+    """
+    segmap = np.asarray(segmap)
+    mask = boundary_map(segmap, connectivity)
+    if mask is None:
+        return None
+    if label_num is None or label_num < int(segmap.max()) + 1:
+        label_num = int(segmap.max()) + 1
+    pixel_ids = np.flatnonzero(mask)
+    labels = segmap.ravel()[pixel_ids]
+    pixel_ids = pixel_ids[np.argsort(labels, kind='stable')]
+    indptr = np.zeros(label_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(labels, minlength=label_num), out=indptr[1:])
+    h_list, w_list = np.divmod(pixel_ids, segmap.shape[1])
+    return indptr, h_list, w_list
+
+
+def relabel_sequential(segmap, batch=False):
+    """
+    Relabel the segmap to the contiguous labels 0..n-1, the order of the
+    labels is kept.
+    RETURN:
+        (segmap, forward, inverse)
+        forward     The [max label + 1] map from the old label to the new
+                    label, the missing old label get -1
+        inverse     The [n] map from the new label to the old label, so
+                    the per-label vector is remapped by vec[inverse]
+        If batch, each segmap in the [b, h, w] batch is relabeled
+        separately, and the forward and inverse are lists
+    """
+    if batch:
+        rst_list = [relabel_sequential(seg) for seg in segmap]
+        return np.stack([rst[0] for rst in rst_list]), \
+            [rst[1] for rst in rst_list], [rst[2] for rst in rst_list]
+    segmap = np.asarray(segmap)
+    inverse, new_segmap = np.unique(segmap, return_inverse=True)
+    forward = np.full(int(inverse[-1]) + 1, -1, dtype=np.int64)
+    forward[inverse] = np.arange(len(inverse))
+    return new_segmap.reshape(segmap.shape), forward, inverse
+
+
+def enforce_connectivity(segmap, connectivity=8, batch=False):
+    """
+    Split the disconnected pieces of a label into new labels. All the
+    labels are processed in one connected-component pass over the pixel
+    graph, whose edges link the adjacent pixels with the same label.
+    The first piece (in raster order) of each label keeps the label, the
+    other pieces get the labels from max label + 1.
+    RETURN:
+        (segmap, parent)
+        parent      The [n] map from the new label to the original label,
+                    so the per-label vector is remapped by vec[parent]
+        If batch, each segmap in the [b, h, w] batch is processed
+        separately, and the parent is a list
+    """
+    if connectivity not in [4, 8]:
+        log.error('\033[01;31mERROR\033[0m: The connectivity must be 4 or 8')
+        return None
+    if batch:
+        rst_list = [enforce_connectivity(seg, connectivity)
+                    for seg in segmap]
+        return np.stack([rst[0] for rst in rst_list]), \
+            [rst[1] for rst in rst_list]
+    segmap = np.asarray(segmap)
+    height, width = segmap.shape
+    flat = segmap.ravel().astype(np.int64)
+    pixel_ids = np.arange(height * width).reshape(height, width)
+
+    # right, down (down right, down left)
+    shift_list = [(np.s_[:, :-1], np.s_[:, 1:]),
+                  (np.s_[:-1, :], np.s_[1:, :])]
+    if connectivity == 8:
+        shift_list += [(np.s_[:-1, :-1], np.s_[1:, 1:]),
+                       (np.s_[:-1, 1:], np.s_[1:, :-1])]
+    src_list = []
+    dst_list = []
+    for a, b in shift_list:
+        same = segmap[a] == segmap[b]
+        src_list.append(pixel_ids[a][same])
+        dst_list.append(pixel_ids[b][same])
+    src = np.concatenate(src_list)
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(len(src)), (src, np.concatenate(dst_list))),
+        shape=(height * width, height * width))
+    comp_num, comp = scipy.sparse.csgraph.connected_components(
+        graph, directed=False)
+
+    # The components are numbered by their first pixel in raster order
+    first_pixel = np.full(comp_num, height * width, dtype=np.int64)
+    np.minimum.at(first_pixel, comp, np.arange(height * width))
+    comp_label = flat[first_pixel]
+    # The first component of each label keeps the label
+    label_num = int(flat.max()) + 1
+    first_comp = np.full(label_num, comp_num, dtype=np.int64)
+    np.minimum.at(first_comp, comp_label, np.arange(comp_num))
+    keep = first_comp[comp_label] == np.arange(comp_num)
+    comp_map = np.zeros(comp_num, dtype=np.int64)
+    comp_map[keep] = comp_label[keep]
+    comp_map[~keep] = label_num + np.arange((~keep).sum())
+
+    parent = np.arange(label_num + (~keep).sum())
+    parent[comp_map[~keep]] = comp_label[~keep]
+    new_segmap = comp_map[comp].reshape(height, width)
+    return new_segmap.astype(segmap.dtype), parent
+
+
 def bilinear_superpixel_pooling(segmap, predmap, ref_num=None,
-                                pred_coord_map=None):
+                                pred_coord_map=None, index=None, plan=None,
+                                batch=False):
     """
     Different from the standard superpixel pooling approach
     This function perform the bilinear superpixel pooling, which is
@@ -625,102 +1116,153 @@ def bilinear_superpixel_pooling(segmap, predmap, ref_num=None,
         function pre-calc this data will save a lot of time
         The shape of the pred_coord_map is [h, w, 2], first channel is H
         and second channel is W
+
+    index:
+        The SegmapIndex of the segmap, built if None
+
+    plan:
+        The bilinear_pooling_plan of the segmap and the predmap shape,
+        calculated if None. The ref_num and pred_coord_map are ignored if
+        the plan is set, pre-calc it when pooling many predmaps against
+        the same segmap
+
+    batch:
+        If True, the predmap is a [b, h, w] or [b, h, w, c] batch share
+        the same segmap, and the result is [b, ...]
+    """
+    predmap = np.asarray(predmap)
+    if not batch:
+        predmap = predmap[np.newaxis]
+    if predmap.ndim == 3:
+        single_channel = True
+        predmap = predmap[:, :, :, np.newaxis]
+    elif predmap.ndim == 4:
+        single_channel = False
+    else:
+        log.error('\033[01;31mERROR\033[0m: Only support the predmap with 2 or 3 \
+dimension. %d' % (predmap.ndim - 1))
+        return None
+    b, h, w, c = predmap.shape
+
+    if plan is None:
+        plan = bilinear_pooling_plan(segmap, [h, w], ref_num,
+                                     pred_coord_map, index)
+    cell_ids, weights = plan
+
+    # [b, label, ref, c] reference values, weighted sum over the ref
+    vals = predmap.reshape(b, h * w, c)[:, cell_ids, :]
+    rst = np.einsum('blkc,lk->blc', vals, weights)
+
+    if single_channel:
+        rst = rst[:, :, 0]
+    if not batch:
+        rst = rst[0]
+    return rst
+
+
+def bilinear_pooling_plan(segmap, pred_shape, ref_num=None,
+                          pred_coord_map=None, index=None):
     """
+    Calc the reference cells and the weights of the bilinear superpixel
+    pooling, which only depend on the segmap and the predmap shape.
+    For each superpixel, the predmap cells inside its projected bbox are
+    ranked by the distance to its central point (the ties are ranked by
+    the cell id), the nearest ref_num cells are selected, and the small
+    dist get bigger weight.
+    The labels are processed in groups of similar bbox size, so the
+    memory is about the total bbox area instead of label_num x the
+    largest bbox.
+    RETURN:
+        (cell_ids, weights), both are [label_num, k] arrays, the cell_ids
+        are the flat ids of the predmap cells, the unused refs get the
+        weight 0
+    """
+    if index is None:
+        index = SegmapIndex(segmap)
     segmap_len = len(np.unique(segmap))
     segmap_max = segmap.max()
     if segmap_max + 1 != segmap_len:
         log.error('\033[01;31mERROR\033[0m: The label of the segmap might \
-not be continuous. %d vs %d' % (segmap_max+1, segmap_len))
-    pixel_num = predmap.shape[0] * predmap.shape[1]
+not be continuous, see relabel_sequential. %d vs %d'
+                  % (segmap_max + 1, segmap_len))
+    label_num = index.label_num
+    lo_height = pred_shape[0]
+    lo_width = pred_shape[1]
     if ref_num is None:
-        ref_num = pixel_num / segmap_len
+        ref_num = lo_height * lo_width // segmap_len
+    ref_num = max(1, int(ref_num))
 
     # Generate the pred_coord_map if needed
     if pred_coord_map is None:
         pred_coord_map = _gen_square_coord_map(segmap.shape[0],
                                                segmap.shape[1],
-                                               predmap.shape[0],
-                                               predmap.shape[1])
-    # Generate the central coord list for segmap
-    seg_coord_list = []
-    for label in range(segmap_len):
-        h_central, w_central = get_central_coord(segmap, label)
-        seg_coord_list.append([h_central, w_central])
-
-    if predmap.ndim == 2:
-        rst = np.zeros(segmap_len)
-    elif predmap.ndim == 3:
-        rst = np.zeros([segmap_len, predmap.shape[2]])
-    else:
-        log.error('\033[01;31mERROR\033[0m: Only support the predmap with 2 or 3 \
-dimension. %d' % predmap.ndim)
-        return None
+                                               lo_height,
+                                               lo_width)
+    pred_coords = np.asarray(pred_coord_map,
+                             dtype=np.float64).reshape(-1, 2)
 
     # The projection rate between the segmap and the predmap
-    h_rate = float(segmap.shape[0]) / float(predmap.shape[0])
-    w_rate = float(segmap.shape[1]) / float(predmap.shape[1])
-
-    # Iter the labels
-    for label in range(segmap_len):
-        # Get the H and W range of the current superpixel
-        pos_hw = np.where(segmap == label)
-        h_list = pos_hw[0]
-        w_list = pos_hw[1]
-        h_min = h_list.min()
-        h_max = h_list.max()
-        w_min = w_list.min()
-        w_max = w_list.max()
-        # Project the range to the predmap
-        hp_min = int(float(h_min) / h_rate)
-        hp_max = int(float(h_max) / h_rate + 1.0)
-        wp_min = int(float(w_min) / w_rate)
-        wp_max = int(float(w_max) / w_rate + 1.0)
-        # Get the central points list of the predmap
-        # Calc the dist between the central point to the ref points
-        pred_val_list = []
-        dist_list = []
-        for hp in range(hp_min, hp_max):
-            for wp in range(wp_min, wp_max):
-                dist_list.append(_dist(seg_coord_list[label],
-                                       pred_coord_map[hp, wp, :]))
-                pred_val_list.append(predmap[hp, wp])
-
-        # Sort according to the dist
-        # TODO: When two dist are exact the same, there might be
-        # a problem
-        dist_dict = dict(zip(dist_list, pred_val_list))
-        pred_val_list = tools.sorted_dict_values(dist_dict)
-        dist_list.sort()
-
-        # bilinear interpolate
-        ref_size = min(ref_num, len(dist_list))
-        dist_total = np.sum(dist_list[0: ref_size])
-        weight_list = []
-        for dist in dist_list[0: ref_size]:
-            # Small dist get bigger weigth
-            weight_list.append(dist_total - dist)
-        weight_arr = np.array(weight_list)
-        if weight_arr.sum() == 0:
-            weight_arr = [1]
-        else:
-            weight_arr = weight_arr / weight_arr.sum()
-        # Interpolation
-        val = np.zeros(pred_val_list[0].shape)
-        for weight, pred_val in zip(weight_arr, pred_val_list):
-            val += weight * pred_val
-
-        rst[label] = val
-
-    return rst
+    h_rate = float(segmap.shape[0]) / float(lo_height)
+    w_rate = float(segmap.shape[1]) / float(lo_width)
+    # Project the bbox of the superpixels to the predmap
+    bboxes = index.bboxes
+    hp_min = (bboxes[:, 0] / h_rate).astype(np.int64)
+    hp_max = np.minimum((bboxes[:, 1] / h_rate + 1.0).astype(np.int64),
+                        lo_height)
+    wp_min = (bboxes[:, 2] / w_rate).astype(np.int64)
+    wp_max = np.minimum((bboxes[:, 3] / w_rate + 1.0).astype(np.int64),
+                        lo_width)
+
+    # Group the labels by the window size rounded up to the power of 2,
+    # so a large superpixel does not pad all the others to its window
+    win_h = hp_max - hp_min
+    win_w = wp_max - wp_min
+    bucket_h = 2 ** np.ceil(np.log2(win_h)).astype(np.int64)
+    bucket_w = 2 ** np.ceil(np.log2(win_w)).astype(np.int64)
+    bucket_key = bucket_h * (bucket_w.max() + 1) + bucket_w
+    k = min(ref_num, int((win_h * win_w).max()))
+    centers = index.central_coords()
+    sel_cell = np.zeros([label_num, k], dtype=np.int64)
+    sel_dist = np.full([label_num, k], np.inf)
+    for key in np.unique(bucket_key):
+        labels = np.flatnonzero(bucket_key == key)
+        # [label, cell] the cells in the bucket window, masked by the bbox
+        off_h, off_w = np.meshgrid(np.arange(bucket_h[labels[0]]),
+                                   np.arange(bucket_w[labels[0]]),
+                                   indexing='ij')
+        hp = hp_min[labels, np.newaxis] + off_h.ravel()
+        wp = wp_min[labels, np.newaxis] + off_w.ravel()
+        inside = (hp < hp_max[labels, np.newaxis]) & \
+            (wp < wp_max[labels, np.newaxis])
+        cell = np.where(inside, hp * lo_width + wp, 0)
+        diff = pred_coords[cell] - centers[labels, np.newaxis, :]
+        dist = np.sqrt((diff ** 2).sum(axis=2))
+        dist[~inside] = np.inf
+        # Select the nearest ref_num cells, the ties are ordered by the
+        # cell id
+        order = np.lexsort((cell, dist), axis=1)[:, 0: k]
+        sel_cell[labels, 0: order.shape[1]] = \
+            np.take_along_axis(cell, order, axis=1)
+        sel_dist[labels, 0: order.shape[1]] = \
+            np.take_along_axis(dist, order, axis=1)
+
+    # Small dist get bigger weight
+    valid = np.isfinite(sel_dist)
+    sel_dist[~valid] = 0
+    weights = (sel_dist.sum(axis=1, keepdims=True) - sel_dist) * valid
+    weight_sum = weights.sum(axis=1)
+    zero = weight_sum == 0
+    weights[~zero] /= weight_sum[~zero, np.newaxis]
+    # Only the nearest cell is used if all the weights are 0
+    weights[zero] = 0
+    weights[zero, 0] = 1
+    return sel_cell, weights
 
 
 def _gen_square_coord_map(hi_height, hi_width, lo_height, lo_width):
-    rst = np.zeros([lo_height, lo_width, 2])
     h_rate = float(hi_height) / float(lo_height)
     w_rate = float(hi_width) / float(lo_width)
-
-    for h in range(lo_height):
-        for w in range(lo_width):
-            rst[h, w, 0] = h * h_rate + h_rate / 2.0
-            rst[h, w, 1] = w * w_rate + w_rate / 2.0
-    return rst
+    h_list = np.arange(lo_height) * h_rate + h_rate / 2.0
+    w_list = np.arange(lo_width) * w_rate + w_rate / 2.0
+    h_map, w_map = np.meshgrid(h_list, w_list, indexing='ij')
+    return np.stack([h_map, w_map], axis=2)
@@ -1,11 +1,203 @@
 # This lib contains the tools for fast serialize, which is useful to
 # store the data into the lmdb database
 
+import argparse
 import numpy as np
+import mmap
+import struct
+import time
 import zlib
 import glog as log
 import snappy
 import color_lib
+# The optional codecs
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    # python 2
+    _buffer = buffer
+except NameError:
+    _buffer = None
+
+# The magic bytes of the v2 format, the first byte of the v1 format is
+# the dtype index (0 - 9), so they never conflict
+MAGIC_V2 = b'\x93SRL'
+# magic, version, flags, dtype, ndim, codec, filter, payload offset
+HEAD_V2 = struct.Struct('<4sBBBBBBH')
+# The flags of the v2 format
+FLAG_BIG_ENDIAN = 1
+FLAG_WIDE_DIMS = 2
+# The magic bytes of the chunked stream format (see serialize_numpy.dump)
+MAGIC_STREAM = b'\x93SRS'
+# The trailer of the stream: index position, magic
+TAIL_STREAM = struct.Struct('<Q4s')
+# The default size of each chunk of the stream
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _zlib_compress(data, level=None):
+    if level is None:
+        return zlib.compress(data)
+    return zlib.compress(data, level)
+
+
+def _lz4_compress(data, level=None):
+    if level is None:
+        return lz4_frame.compress(data)
+    return lz4_frame.compress(data, compression_level=level)
+
+
+def _zstd_compress(data, level=None):
+    if level is None:
+        level = 3
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# The codecs: name -> [id, compress func (data, level), decompress func]
+# The id is recorded in the v2 head, so never change it
+CODECS = {'none': [0, None, None],
+          'snappy': [1, lambda data, level=None: snappy.compress(data),
+                     snappy.decompress],
+          'zlib': [2, _zlib_compress, zlib.decompress],
+          'lz4': [3, _lz4_compress,
+                  lz4_frame.decompress if lz4_frame is not None else None],
+          'zstd': [4, _zstd_compress, _zstd_decompress]}
+# The codecs which need the optional module
+_OPTIONAL_CODECS = {'lz4': lz4_frame, 'zstd': zstandard}
+
+# The pre-filters of the payload: name -> id (recorded in the v2 head)
+# byte: Group the n-th bytes of all items together (Blosc shuffle)
+# bit: Group the n-th bits of all items together (Blosc bitshuffle)
+FILTERS = {'none': 0, 'byte': 1, 'bit': 2}
+
+
+def codec_available(codec):
+    """
+    Check if the codec can be used
+    """
+    if codec not in CODECS:
+        return False
+    return _OPTIONAL_CODECS.get(codec, True) is not None
+
+
+def byte_shuffle(data, itemsize):
+    """
+    Transpose the [n, itemsize] bytes to [itemsize, n], so the similar
+    high bytes of the numbers are put together
+    """
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize)
+    return np.ascontiguousarray(arr.T).tobytes()
+
+
+def byte_unshuffle(data, itemsize):
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(arr.T).tobytes()
+
+
+def bit_shuffle(data, itemsize):
+    """
+    Transpose the [n, itemsize * 8] bits to [itemsize * 8, n], the n is
+    padded to the multiple of 8.
+    NOTE: The bits are unpacked in memory, which takes 8x of the data
+    """
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize)
+    num = arr.shape[0]
+    pad = (-num) % 8
+    bits = np.unpackbits(arr, axis=1)
+    if pad:
+        bits = np.concatenate(
+            [bits, np.zeros([pad, bits.shape[1]], dtype=np.uint8)])
+    return np.packbits(bits.T, axis=1).tobytes()
+
+
+def bit_unshuffle(data, itemsize, num):
+    """
+    The num is the item number before padding
+    """
+    arr = np.frombuffer(data, dtype=np.uint8).reshape(itemsize * 8, -1)
+    bits = np.unpackbits(arr, axis=1)[:, :num]
+    return np.packbits(bits.T, axis=1).tobytes()
+
+
+def _encode_payload(array, codec, level=None, filter_name='none'):
+    """
+    Convert the array into the payload string, return the payload and the
+    filter id which is actually used
+    """
+    data_str = np.ascontiguousarray(array).tobytes()
+    itemsize = array.dtype.itemsize
+    if filter_name == 'byte' and itemsize > 1:
+        data_str = byte_shuffle(data_str, itemsize)
+    elif filter_name == 'bit' and array.size > 0:
+        data_str = bit_shuffle(data_str, itemsize)
+    else:
+        filter_name = 'none'
+    if codec != 'none':
+        data_str = CODECS[codec][1](data_str, level)
+    return data_str, FILTERS[filter_name]
+
+
+def _decode_payload(payload, dtype, shape, codec, filter_id):
+    """
+    Convert the payload back to the array
+    If there is no codec and no filter, the array is a read only view of
+    the payload, otherwise it is decoded into a new writable array
+    """
+    if codec == 'none' and filter_id == FILTERS['none']:
+        return np.frombuffer(payload, dtype=dtype).reshape(shape)
+    if codec != 'none':
+        payload = CODECS[codec][2](payload)
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if filter_id == FILTERS['byte']:
+        data = np.ascontiguousarray(data.reshape(dtype.itemsize, -1).T)
+    elif filter_id == FILTERS['bit']:
+        bits = np.unpackbits(data.reshape(dtype.itemsize * 8, -1),
+                             axis=1)[:, :int(np.prod(shape))]
+        data = np.packbits(bits.T, axis=1)
+    else:
+        # The decompressed bytes are immutable
+        data = np.frombuffer(bytearray(payload), dtype=np.uint8)
+    return data.reshape(-1).view(dtype).reshape(shape)
+
+
+def _slice(buf, start, stop=None):
+    """
+    Return buf[start: stop] (buf can be a str, buffer or mmap) without
+    copy. It is a buffer in python 2, since the decompressors and
+    np.frombuffer of python 2 can not read a memoryview, and a memoryview
+    in python 3.
+    """
+    if stop is None:
+        stop = len(buf)
+    start = int(min(start, len(buf)))
+    stop = int(max(start, min(stop, len(buf))))
+    if _buffer is not None:
+        if isinstance(buf, memoryview):
+            # buffer() can not wrap a memoryview, copy the slice
+            return buf[start: stop].tobytes()
+        return _buffer(buf, start, stop - start)
+    return memoryview(buf)[start: stop]
+
+
+def _to_bytes(buf, start, stop):
+    """
+    Copy buf[start: stop] into a string, NOTE: bytes(memoryview) is the
+    repr of it in python 2
+    """
+    data = _slice(buf, start, stop)
+    if _buffer is not None:
+        return str(data)
+    return data.tobytes()
 
 
 class serialize_numpy:
@@ -13,49 +205,78 @@ class serialize_numpy:
     This class serialize and de-serialize the numpy array
     into string
     -----------------------------------------------------
-    The format of the serialized string
+    The format v1 of the serialized string (the whole string is compressed)
     byte[0]:int8     The dtype of the numpy data, see the self._types
     byte[1]:int8     The dims of the array, e.g. for rgb image, byte[1] = 3
     byte[2:4]:int16  The first dim size
     byte[4:6]:int16  The second dim size
     byte[6:8]:int16  The third dim size
     ...
+    -----------------------------------------------------
+    The format v2 of the serialized string (only the payload is compressed)
+    byte[0:4]:       The magic bytes MAGIC_V2
+    byte[4]:uint8    The version, 2
+    byte[5]:uint8    The flags, FLAG_BIG_ENDIAN and FLAG_WIDE_DIMS
+    byte[6]:uint8    The dtype of the numpy data, see the self._types
+    byte[7]:uint8    The dims of the array
+    byte[8]:uint8    The codec id of the payload, see CODECS
+    byte[9]:uint8    The filter id of the payload, see FILTERS
+    byte[10:12]:uint16  The offset of the payload
+    byte[12:]        The dim sizes, uint32 (uint64 if FLAG_WIDE_DIMS)
+    The head is padded to the multiple of align, so when the payload is
+    not compressed, loads return a np.frombuffer view of the string
+    without copy.
     """
-    def __init__(self, compress=True, compressor='snappy'):
+    def __init__(self, compress=True, compressor='snappy', version=2,
+                 align=16, level=None, shuffle='none'):
         """
-        The compressor can be snappy or zlib
+        The compressor can be none, snappy, zlib, lz4 or zstd
+        The version is the format version of dumps, loads can read both
+        The level is the compress level of zlib, lz4 and zstd, None means
+        the default level of the codec
+        The shuffle is the pre-filter of the v2 format, which can be none,
+        byte or bit. It makes the multi-byte data (e.g. float32 depth map)
+        much easier to compress
+        The codec and the filter are recorded in the v2 head, so loads can
+        read the string produced with any setting
         """
+        # The codec id -> name
+        self._codec_names = dict([(val[0], key)
+                                  for key, val in CODECS.items()])
+        if compressor == 'none':
+            compress = False
         self._compress = compress
+        self._version = version
+        self._align = align
+        self._level = level
+        if shuffle is None:
+            shuffle = 'none'
+        self._shuffle = shuffle
         self._types = ['uint8', 'int8', 'uint16', 'int16', 'uint32',
                        'int32', 'uint64', 'int64', 'float32', 'float64']
         self._color = color_lib.color(True)
         self._err = self._color.red('ERROR') + ': '
-        if compressor == 'snappy':
-            self._compressor = snappy.compress
-            self._decompressor = snappy.decompress
-        elif compressor == 'zlib':
-            self._compressor = zlib.compress
-            self._decompressor = zlib.decompress
-        else:
+        if shuffle not in FILTERS:
+            log.error(self._err + 'Can not recognize the shuffle: %s'
+                      % shuffle)
+            return
+        if not codec_available(compressor):
             log.error(self._err + 'Can not recognize the compressor: %s'
                       % compressor)
             return
+        self._codec = compressor
+        self._compressor = CODECS[compressor][1]
+        self._decompressor = CODECS[compressor][2]
 
     def _parse_head(self, raw_data_str):
         """
         Parse the input string
         return dtype, shape, pure_data_str
         """
-        btype = raw_data_str[0]
-        dtype_idx = np.fromstring(btype, dtype='int8')[0]
+        dtype_idx, dims = struct.unpack_from('<bb', raw_data_str, 0)
         dtype = self._types[dtype_idx]
-        bdims = raw_data_str[1]
-        dims = np.fromstring(bdims, dtype='int8')[0]
-        shape = []
-        for idx in range(2, 2 * dims + 1, 2):
-            bdim = raw_data_str[idx: idx + 2]
-            dim = np.fromstring(bdim, dtype='int16')[0]
-            shape.append(dim)
+        shape = np.frombuffer(raw_data_str, dtype='int16', count=dims,
+                              offset=2).tolist()
         # Calc the head length
         headlen = 2 + 2 * dims
         data_str = raw_data_str[headlen:]
@@ -72,35 +293,631 @@ class serialize_numpy:
             log.error(self._err + 'Unknown dtype ' + self._color.red(dtype))
             log.error('The current dtype: %s' % str(self._types))
             return
+        if len(shape) > 0 and max(shape) > 32767:
+            log.error(self._err + 'The dim size %s can not be stored in v1 \
+format, use v2 instead' % str(shape))
+            return
 
-        head = np.int8(dtype_idx).tostring()
-        dims = np.int8(len(shape))
-        head += dims.tostring()
-        for dim in shape:
-            head += np.int16(dim).tostring()
+        head = struct.pack('<bb', dtype_idx, len(shape))
+        head += np.array(shape, dtype='int16').tobytes()
 
         return head + data_str
 
+    def _pack_head_v2(self, dtype, shape, codec, filter_id=0,
+                      magic=MAGIC_V2, extra=b''):
+        """
+        Pack the v2 head (with padding) of the array
+        The extra bytes are put after the dims (used by the stream head)
+        """
+        try:
+            dtype_idx = self._types.index(dtype.newbyteorder('='))
+        except:
+            log.error(self._err + 'Unknown dtype ' +
+                      self._color.red(str(dtype)))
+            log.error('The current dtype: %s' % str(self._types))
+            return None
+        flags = 0
+        if dtype.byteorder == '>' or \
+                (dtype.byteorder == '=' and np.little_endian is False):
+            flags |= FLAG_BIG_ENDIAN
+        if magic == MAGIC_STREAM or \
+                (len(shape) > 0 and max(shape) > 0xffffffff):
+            flags |= FLAG_WIDE_DIMS
+            dims = np.array(shape, dtype='<u8').tobytes()
+        else:
+            dims = np.array(shape, dtype='<u4').tobytes()
+        headlen = HEAD_V2.size + len(dims) + len(extra)
+        offset = (headlen + self._align - 1) // self._align * self._align
+        head = HEAD_V2.pack(magic, 2, flags, dtype_idx, len(shape),
+                            CODECS[codec][0], filter_id, offset)
+        return head + dims + extra + b'\0' * (offset - headlen)
+
+    def _parse_head_v2(self, raw_data_str):
+        """
+        Parse the v2 head, return dtype, shape, codec, filter_id, offset
+        """
+        magic, version, flags, dtype_idx, ndim, codec_id, filter_id, \
+            offset = HEAD_V2.unpack_from(raw_data_str, 0)
+        dtype = np.dtype(self._types[dtype_idx])
+        if flags & FLAG_BIG_ENDIAN:
+            dtype = dtype.newbyteorder('>')
+        else:
+            dtype = dtype.newbyteorder('<')
+        if flags & FLAG_WIDE_DIMS:
+            dim_type = '<u8'
+        else:
+            dim_type = '<u4'
+        shape = np.frombuffer(raw_data_str, dtype=dim_type, count=ndim,
+                              offset=HEAD_V2.size).tolist()
+        return dtype, shape, self._codec_names[codec_id], filter_id, offset
+
+    def is_v2(self, raw_data_str):
+        """
+        Check if the string is in v2 format
+        """
+        return _to_bytes(raw_data_str, 0, len(MAGIC_V2)) == MAGIC_V2
+
     def dumps(self, array):
         """
         dump the array into the strings
         """
         if type(array) != np.ndarray:
             array = np.array(array)
-        data_str = array.tostring()
+        if self._version == 1:
+            return self._dumps_v1(array)
+
+        if self._compress:
+            codec = self._codec
+        else:
+            codec = 'none'
+        data_str, filter_id = _encode_payload(array, codec, self._level,
+                                              self._shuffle)
+        head = self._pack_head_v2(array.dtype, array.shape, codec, filter_id)
+        if head is None:
+            return None
+        return head + data_str
+
+    def _dumps_v1(self, array):
+        data_str = array.tobytes()
         raw_data_str = self._add_head(data_str, array.dtype, array.shape)
+        if raw_data_str is None:
+            return None
         if self._compress:
-            raw_data_str = self._compressor(raw_data_str)
+            raw_data_str = self._compressor(raw_data_str, self._level)
         return raw_data_str
 
     def loads(self, raw_data_str):
         """
         de-serialize the string into the numpy array
+        NOTE:
+            Without compression and shuffle, the v2 array is a read only
+            view of the raw_data_str (e.g. the lmdb buffer), copy it if it
+            need to be changed or kept after the buffer is released.
+            Otherwise the array is writable.
         """
+        if self.is_v2(raw_data_str):
+            return self._loads_v2(raw_data_str)
+
         if self._compress:
             raw_data_str = self._decompressor(raw_data_str)
         # Parse the string
         dtype, shape, data_str = self._parse_head(raw_data_str)
-        array = np.fromstring(data_str, dtype=dtype)
+        array = np.frombuffer(data_str, dtype=dtype).copy()
         array = array.reshape(shape)
         return array
+
+    def _loads_v2(self, raw_data_str):
+        dtype, shape, codec, filter_id, offset = \
+            self._parse_head_v2(raw_data_str)
+        if codec == 'none' and filter_id == FILTERS['none']:
+            array = np.frombuffer(raw_data_str, dtype=dtype, offset=offset)
+            return array.reshape(shape)
+        if not codec_available(codec):
+            log.error(self._err + 'The codec %s is not installed' % codec)
+            return None
+        return _decode_payload(_slice(raw_data_str, offset), dtype, shape,
+                               codec, filter_id)
+
+    def dump(self, array, fileobj, chunk_bytes=CHUNK_BYTES):
+        """
+        Write the array (can be a np.memmap) into the fileobj as a chunked
+        stream. The array is split by the rows (the first dim), and each
+        chunk is compressed independently, so the peak memory is about
+        the size of a chunk instead of 3x of the array.
+        -----------------------------------------------------
+        The format of the stream
+        The v2 head with MAGIC_STREAM, the dims are always uint64, and
+        followed by the rows_per_chunk:uint64, chunk_num:uint64 and
+        index_offset:uint64 (patched after the chunks are written)
+        The chunks
+        The chunk index: [offset:uint64, length:uint64] of each chunk
+        The trailer TAIL_STREAM: the index offset and MAGIC_STREAM
+        All offsets are relative to the start of the stream, so the end
+        of the stream is known from the head, and other data can follow
+        the stream in the same file. The fileobj must be seekable.
+        """
+        if not isinstance(array, np.ndarray):
+            array = np.array(array)
+        shape = array.shape
+        if array.ndim == 0:
+            array = array.reshape(1)
+        row_bytes = max(1, array[0: 1].nbytes)
+        rows = array.shape[0]
+        rows_per_chunk = max(1, chunk_bytes // row_bytes)
+        chunk_num = (rows + rows_per_chunk - 1) // rows_per_chunk
+        if self._compress:
+            codec = self._codec
+        else:
+            codec = 'none'
+
+        start = fileobj.tell()
+        # The filter id is only known after encoding, so the head is
+        # packed with the filter that will be used
+        filter_name = self._shuffle
+        if filter_name == 'byte' and array.dtype.itemsize == 1:
+            filter_name = 'none'
+        head = self._pack_head_v2(array.dtype, shape, codec,
+                                  FILTERS[filter_name], magic=MAGIC_STREAM,
+                                  extra=struct.pack('<QQQ', rows_per_chunk,
+                                                    chunk_num, 0))
+        if head is None:
+            return None
+        fileobj.write(head)
+        pos = len(head)
+        index = np.zeros([chunk_num, 2], dtype='<u8')
+        for idx in range(chunk_num):
+            chunk = array[idx * rows_per_chunk: (idx + 1) * rows_per_chunk]
+            data_str, _ = _encode_payload(chunk, codec, self._level,
+                                          filter_name)
+            fileobj.write(data_str)
+            index[idx] = [pos, len(data_str)]
+            pos += len(data_str)
+        fileobj.write(index.tobytes())
+        fileobj.write(TAIL_STREAM.pack(pos, MAGIC_STREAM))
+        end = fileobj.tell()
+        # Patch the index offset in the head
+        fileobj.seek(start + HEAD_V2.size + 8 * len(shape) + 16)
+        fileobj.write(struct.pack('<Q', pos))
+        fileobj.seek(end)
+        return end - start
+
+    def _parse_stream(self, fileobj, use_mmap):
+        """
+        Return buf, dtype, shape, codec, filter_id, offset, rows_per_chunk,
+        index of the stream start at the current position of the fileobj
+        The buf is a mmap of the file if use_mmap is True and the fileobj
+        has a fileno, else it is the content of the stream.
+        The fileobj is moved to the end of the stream.
+        """
+        start = fileobj.tell()
+        buf = None
+        mapped = False
+        if use_mmap:
+            try:
+                buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+                buf = _slice(buf, start)
+                mapped = True
+            except (AttributeError, EnvironmentError, ValueError):
+                # e.g. BytesIO, read it instead
+                buf = None
+        if buf is None:
+            buf = fileobj.read(HEAD_V2.size)
+            if len(buf) == HEAD_V2.size:
+                offset = HEAD_V2.unpack(buf)[-1]
+                buf += fileobj.read(max(0, offset - HEAD_V2.size))
+        head = self._parse_stream_head(buf)
+        if head is None:
+            log.error(self._err + 'The file is not a serialized stream')
+            return None
+        dtype, shape, codec, filter_id, offset, rows_per_chunk, chunk_num, \
+            index_pos = head
+        end = index_pos + chunk_num * 16 + TAIL_STREAM.size
+        if not mapped:
+            buf = buf + fileobj.read(end - len(buf))
+        if len(buf) < end:
+            log.error(self._err + 'The stream is truncated')
+            return None
+        tail_pos, magic = TAIL_STREAM.unpack_from(buf, end - TAIL_STREAM.size)
+        if magic != MAGIC_STREAM or tail_pos != index_pos:
+            log.error(self._err + 'The file is not a serialized stream')
+            return None
+        fileobj.seek(start + end)
+        index = np.frombuffer(buf, dtype='<u8', count=chunk_num * 2,
+                              offset=index_pos).reshape(-1, 2)
+        return buf, dtype, shape, codec, filter_id, offset, \
+            rows_per_chunk, index
+
+    def _parse_stream_head(self, buf):
+        """
+        Parse the stream head, return dtype, shape, codec, filter_id,
+        offset, rows_per_chunk, chunk_num, index_pos
+        Return None if the buf is not a stream head
+        """
+        if len(buf) < HEAD_V2.size or \
+                _to_bytes(buf, 0, len(MAGIC_STREAM)) != MAGIC_STREAM:
+            return None
+        offset = HEAD_V2.unpack_from(buf, 0)[-1]
+        if len(buf) < offset:
+            return None
+        dtype, shape, codec, filter_id, offset = self._parse_head_v2(buf)
+        rows_per_chunk, chunk_num, index_pos = struct.unpack_from(
+            '<QQQ', buf, HEAD_V2.size + 8 * len(shape))
+        return dtype, shape, codec, filter_id, offset, rows_per_chunk, \
+            chunk_num, index_pos
+
+    def load(self, fileobj, mmap=True):
+        """
+        Load the array from the chunked stream written by dump
+        If mmap is True, the file is memory mapped instead of read (the
+        fileobj without fileno, e.g. BytesIO, is read), and when the
+        stream is not compressed and not filtered, the array is a read
+        only view of the file, which is never fully loaded in RAM.
+        """
+        return self.load_rows(fileobj, 0, None, mmap)
+
+    def load_rows(self, fileobj, start, stop=None, mmap=True):
+        """
+        Load the rows [start, stop) of the array from the chunked stream,
+        only the chunks cover the rows are read and decompressed.
+        """
+        rst = self._parse_stream(fileobj, mmap)
+        if rst is None:
+            return None
+        buf, dtype, shape, codec, filter_id, offset, rows_per_chunk, \
+            index = rst
+        full_shape = shape
+        if len(shape) == 0:
+            shape = [1]
+        if stop is None or stop > shape[0]:
+            stop = shape[0]
+        start = max(0, min(start, stop))
+        row_shape = shape[1:]
+
+        if codec == 'none' and filter_id == FILTERS['none']:
+            # The chunks are stored one by one, so it is one array
+            row_size = int(np.prod(row_shape))
+            array = np.frombuffer(buf, dtype=dtype,
+                                  count=(stop - start) * row_size,
+                                  offset=offset + start * row_size *
+                                  dtype.itemsize)
+            array = array.reshape([stop - start] + row_shape)
+        else:
+            if not codec_available(codec):
+                log.error(self._err + 'The codec %s is not installed'
+                          % codec)
+                return None
+            array = np.empty([stop - start] + row_shape, dtype=dtype)
+            first = start // rows_per_chunk
+            last = (stop + rows_per_chunk - 1) // rows_per_chunk
+            for idx in range(first, last):
+                chunk_start = idx * rows_per_chunk
+                chunk_rows = min(rows_per_chunk, shape[0] - chunk_start)
+                pos, length = index[idx]
+                chunk = _decode_payload(_slice(buf, pos, pos + length),
+                                        dtype, [chunk_rows] + row_shape,
+                                        codec, filter_id)
+                src_start = max(start, chunk_start)
+                src_stop = min(stop, chunk_start + chunk_rows)
+                array[src_start - start: src_stop - start] = \
+                    chunk[src_start - chunk_start: src_stop - chunk_start]
+        if len(full_shape) == 0:
+            return array.reshape(full_shape)
+        return array
+
+
+# The magic bytes of the bundle format
+MAGIC_BUNDLE = b'\x93SRB'
+# magic, version, field number, table length
+HEAD_BUNDLE = struct.Struct('<4sBxHI')
+# The table entry: offset, length, name length, followed by the name
+ENTRY_BUNDLE = struct.Struct('<QQH')
+
+
+class serialize_bundle:
+    """
+    This class serialize several named arrays (e.g. image, depth, normal
+    and segmap of a sample) into ONE string, so one lmdb lookup serves
+    all of them, and loads_field only decode the required field.
+    -----------------------------------------------------
+    The format of the serialized string
+    byte[0:4]:       The magic bytes MAGIC_BUNDLE
+    byte[4]:uint8    The version, 1
+    byte[6:8]:uint16 The field number
+    byte[8:12]:uint32   The length of the table
+    byte[12:]        The table, each entry is
+                     offset:uint64, length:uint64, name_len:uint16, name
+    Then the fields, each field is a serialize_numpy v2 string which
+    starts at the multiple of align, so every field is compressed
+    individually and can be read as a view of the bundle.
+    """
+    def __init__(self, compress=True, compressor='snappy', align=16,
+                 level=None, shuffle='none', field_param=None):
+        """
+        The compress, compressor, level and shuffle are the default param
+        of the fields, see serialize_numpy
+        field_param: {name: {param: val}}, override the param of certain
+        fields, e.g. {'segmap': {'shuffle': 'none'}}
+        """
+        self._align = align
+        self._param = {'compress': compress, 'compressor': compressor,
+                       'align': align, 'level': level, 'shuffle': shuffle}
+        if field_param is None:
+            field_param = {}
+        self._field_param = field_param
+        self._serializers = {}
+        self._loader = serialize_numpy(compress=False, align=align)
+
+    def _get_serializer(self, name):
+        if name not in self._serializers:
+            param = dict(self._param)
+            param.update(self._field_param.get(name, {}))
+            # The field must be v2, so the loader can detect its codec
+            param['version'] = 2
+            self._serializers[name] = serialize_numpy(**param)
+        return self._serializers[name]
+
+    def dumps(self, array_dict):
+        """
+        The array_dict is a dict or a list of [name, array], the order of
+        the list is kept, and the dict is sorted by the name
+        """
+        if isinstance(array_dict, dict):
+            item_list = sorted(array_dict.items())
+        else:
+            item_list = list(array_dict)
+
+        name_list = [str(name).encode('utf8') for name, _ in item_list]
+        field_list = [self._get_serializer(name).dumps(array)
+                      for name, array in item_list]
+        if None in field_list:
+            return None
+
+        table_len = sum([ENTRY_BUNDLE.size + len(name)
+                         for name in name_list])
+        offset = HEAD_BUNDLE.size + table_len
+        table = []
+        pad_list = []
+        for name, field in zip(name_list, field_list):
+            pad = (-offset) % self._align
+            offset += pad
+            pad_list.append(b'\0' * pad)
+            table.append(ENTRY_BUNDLE.pack(offset, len(field), len(name)))
+            table.append(name)
+            offset += len(field)
+
+        rst = [HEAD_BUNDLE.pack(MAGIC_BUNDLE, 1, len(name_list), table_len)]
+        rst.extend(table)
+        for pad, field in zip(pad_list, field_list):
+            rst.append(pad)
+            rst.append(field)
+        return b''.join(rst)
+
+    def parse_table(self, raw_data_str):
+        """
+        Return the list of [name, offset, length] of the fields
+        """
+        magic, version, field_num, table_len = \
+            HEAD_BUNDLE.unpack_from(raw_data_str, 0)
+        if magic != MAGIC_BUNDLE:
+            log.error('\033[01;31mERROR\033[0m: The string is not a bundle')
+            return None
+        table = []
+        pos = HEAD_BUNDLE.size
+        for idx in range(field_num):
+            offset, length, name_len = \
+                ENTRY_BUNDLE.unpack_from(raw_data_str, pos)
+            pos += ENTRY_BUNDLE.size
+            name = _to_bytes(raw_data_str, pos, pos + name_len).decode('utf8')
+            pos += name_len
+            table.append([name, offset, length])
+        return table
+
+    def field_names(self, raw_data_str):
+        table = self.parse_table(raw_data_str)
+        if table is None:
+            return None
+        return [val[0] for val in table]
+
+    def loads_field(self, raw_data_str, name):
+        """
+        Only decode the field of the given name, the other fields are not
+        touched. If the name is not found, return None
+        """
+        table = self.parse_table(raw_data_str)
+        if table is None:
+            return None
+        for field_name, offset, length in table:
+            if field_name == name:
+                return self._loader.loads(
+                    _slice(raw_data_str, offset, offset + length))
+        log.error('\033[01;31mERROR\033[0m: Can not find the field %s in \
+the bundle' % name)
+        return None
+
+    def loads(self, raw_data_str, names=None):
+        """
+        Decode the fields into a dict, if names is set, only decode the
+        fields in names
+        """
+        table = self.parse_table(raw_data_str)
+        if table is None:
+            return None
+        rst_dict = {}
+        for name, offset, length in table:
+            if names is not None and name not in names:
+                continue
+            rst_dict[name] = self._loader.loads(
+                _slice(raw_data_str, offset, offset + length))
+        return rst_dict
+
+
+# The default levels tried by the benchmark, None is the codec default
+BENCH_LEVELS = {'none': [None], 'snappy': [None], 'zlib': [1, 6],
+                'lz4': [None], 'zstd': [1, 3, 9]}
+
+
+def benchmark_codecs(array_list, codecs=None, shuffles=None, levels=None,
+                     repeat=3):
+    """
+    Measure every available codec, shuffle and level combination on the
+    sample arrays (better to be real data, e.g. from sample_lmdb).
+    codecs, shuffles: The list to try, None means all available
+    levels: {codec: [level]}, None means BENCH_LEVELS
+    Return the list of dict, each contains:
+        codec, shuffle, level, ratio (raw size / serialized size),
+        encode (MB/s), decode (MB/s)
+    """
+    if codecs is None:
+        codecs = [codec for codec in sorted(CODECS)
+                  if codec_available(codec)]
+    if shuffles is None:
+        shuffles = sorted(FILTERS)
+    if levels is None:
+        levels = BENCH_LEVELS
+    array_list = [np.asarray(array) for array in array_list]
+    raw_size = float(sum([array.nbytes for array in array_list]))
+    mb = raw_size / 1024.0 / 1024.0
+
+    rst_list = []
+    for codec in codecs:
+        for shuffle in shuffles:
+            for level in levels.get(codec, [None]):
+                serializer = serialize_numpy(compress=codec != 'none',
+                                             compressor=codec
+                                             if codec != 'none'
+                                             else 'snappy',
+                                             level=level, shuffle=shuffle)
+                start = time.time()
+                for i in range(repeat):
+                    str_list = [serializer.dumps(array)
+                                for array in array_list]
+                encode_time = (time.time() - start) / repeat
+                start = time.time()
+                for i in range(repeat):
+                    for data_str in str_list:
+                        serializer.loads(data_str)
+                decode_time = (time.time() - start) / repeat
+                size = sum([len(data_str) for data_str in str_list])
+                rst_list.append({'codec': codec, 'shuffle': shuffle,
+                                 'level': level,
+                                 'ratio': raw_size / max(size, 1),
+                                 'encode': mb / max(encode_time, 1e-9),
+                                 'decode': mb / max(decode_time, 1e-9)})
+    return rst_list
+
+
+def select_codec(rst_list, objective='decode', size_budget=None):
+    """
+    Choose the best result of benchmark_codecs
+    objective:
+        decode: The fastest decode
+        encode: The fastest encode
+        size: The smallest size
+    size_budget: The max serialized size relative to the raw size, e.g.
+        0.5 means the result must be at least 2x smaller. If no result
+        fits the budget, the smallest one is chosen
+    """
+    if size_budget is not None:
+        cand_list = [rst for rst in rst_list
+                     if 1.0 / rst['ratio'] <= size_budget]
+        if len(cand_list) == 0:
+            log.warn('\033[01;33mWARNING\033[0m: No codec fits the size \
+budget %f, choose the smallest' % size_budget)
+            objective = 'size'
+            cand_list = rst_list
+    else:
+        cand_list = rst_list
+    if objective == 'size':
+        key = 'ratio'
+    elif objective in ['decode', 'encode']:
+        key = objective
+    else:
+        log.error('\033[01;31mERROR\033[0m: Unknown objective %s'
+                  % objective)
+        return None
+    return max(cand_list, key=lambda rst: rst[key])
+
+
+def auto_serializer(array_list, objective='decode', size_budget=None):
+    """
+    Benchmark the sample arrays, and return the serialize_numpy which
+    best fits the objective (see select_codec)
+    """
+    best = select_codec(benchmark_codecs(array_list), objective,
+                        size_budget)
+    if best is None:
+        return None
+    if best['codec'] == 'none':
+        return serialize_numpy(compress=False, shuffle=best['shuffle'])
+    return serialize_numpy(compressor=best['codec'], level=best['level'],
+                           shuffle=best['shuffle'])
+
+
+def sample_lmdb(db_file, num=100, parser=None):
+    """
+    Return the first num values of the lmdb as arrays, the parser convert
+    the value to array, by default it is serialize_numpy().loads
+    """
+    # Only the lmdb tools need the lmdb module
+    import lmdb_tools
+    if parser is None:
+        parser = serialize_numpy().loads
+    db = lmdb_tools.open_ro(db_file)
+    if db is None:
+        log.error('\033[01;31mERROR\033[0m: Can not open %s' % db_file)
+        return None
+    array_list = []
+    with db.begin(write=False) as txn:
+        with txn.cursor() as cur:
+            for key, val in cur:
+                array_list.append(np.array(parser(val)))
+                if len(array_list) >= num:
+                    break
+    lmdb_tools.close(db)
+    return array_list
+
+
+def print_benchmark(rst_list):
+    """
+    Display the result of benchmark_codecs, sorted by the ratio
+    """
+    log.info('%-8s %-6s %-6s %8s %12s %12s' % ('codec', 'filter', 'level',
+                                               'ratio', 'encode MB/s',
+                                               'decode MB/s'))
+    for rst in sorted(rst_list, key=lambda rst: -rst['ratio']):
+        log.info('%-8s %-6s %-6s %8.2f %12.1f %12.1f'
+                 % (rst['codec'], rst['shuffle'], str(rst['level']),
+                    rst['ratio'], rst['encode'], rst['decode']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the codecs on the values of a lmdb which is \
+serialized by serialize_numpy, and recommend the best one')
+    parser.add_argument('db_file', help='The lmdb')
+    parser.add_argument('--num', type=int, default=100,
+                        help='The number of values to sample')
+    parser.add_argument('--compressor', default='snappy',
+                        help='The compressor of the v1 values in the db')
+    parser.add_argument('--objective', default='decode',
+                        help='decode, encode or size')
+    parser.add_argument('--size_budget', type=float, default=None,
+                        help='The max serialized size relative to the raw \
+size')
+    args = parser.parse_args()
+
+    array_list = sample_lmdb(args.db_file, args.num,
+                             serialize_numpy(
+                                 compressor=args.compressor).loads)
+    if not array_list:
+        return
+    rst_list = benchmark_codecs(array_list)
+    print_benchmark(rst_list)
+    best = select_codec(rst_list, args.objective, args.size_budget)
+    if best is not None:
+        log.info('Recommend: compressor=%s, level=%s, shuffle=%s'
+                 % (best['codec'], str(best['level']), best['shuffle']))
+
+
+if __name__ == '__main__':
+    main()